@@ -0,0 +1,67 @@
+"""
+Compares the nn.MultiheadAttention trunks, sequence-first with explicit masks,
+with the batch-first scaled_dot_product_attention ones, which share their
+weights, checking that the embeddings match and timing both.
+
+    python -m benchmarks.fused_attention --modality text --checkpoint .checkpoints/imagebind_huge.pth
+"""
+
+import argparse
+import time
+
+import torch
+
+from benchmarks.pooled_block import make_inputs
+from pegasus.ImageBind.models.imagebind_model import ModalityType, imagebind_huge
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--modality",
+        default=ModalityType.TEXT,
+        choices=[ModalityType.VISION, ModalityType.TEXT, ModalityType.AUDIO],
+    )
+    parser.add_argument(
+        "--checkpoint", default=None, help="Random weights if not given"
+    )
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    reference = imagebind_huge(
+        pretrained=args.checkpoint is not None,
+        checkpoint_path=args.checkpoint,
+        modalities=[args.modality],
+        fast_load=True,
+        fused_attention=False,
+    ).eval()
+    # built on the meta device and assigned the weights of the reference
+    with torch.device("meta"):
+        fused = imagebind_huge(modalities=[args.modality], fused_attention=True)
+    fused.load_state_dict(reference.state_dict(), assign=True)
+    fused.eval()
+
+    inputs = {args.modality: make_inputs(args.modality, args.batch_size)}
+
+    with torch.no_grad():
+        difference = (
+            (reference(inputs)[args.modality] - fused(inputs)[args.modality])
+            .abs()
+            .max()
+            .item()
+        )
+        print(f"max abs difference over {args.batch_size} inputs: {difference:.2e}")
+        assert difference < 1e-4
+
+        for name, model in (("nn.MultiheadAttention", reference), ("SDPA", fused)):
+            model(inputs)
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                model(inputs)
+            elapsed = (time.perf_counter() - start) / args.repeats
+            print(f"{name}: {elapsed * 1000:.1f} ms per batch of {args.batch_size}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Measures the import time of pegasus entry points in fresh interpreters and
+checks that none of them loads a dependency it does not need.
+
+    python -m benchmarks.import_time
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEDIA_STACKS = ["torchvision", "torchaudio", "pytorchvideo", "decord", "PIL"]
+HEAVY_MODULES = ["torch", "timm", "sklearn", "ftfy", "iopath", "numba"] + MEDIA_STACKS
+
+# (name, statement, modules the statement must not import)
+CASES = [
+    ("import pegasus", "import pegasus", HEAVY_MODULES),
+    (
+        "from pegasus import Pegasus",
+        "from pegasus import Pegasus",
+        ["timm", "sklearn", "ftfy", "iopath", "numba"] + MEDIA_STACKS,
+    ),
+    (
+        "text worker",
+        "import torch\n"
+        "from pegasus.ImageBind.data import load_and_transform_text\n"
+        "from pegasus.ImageBind.models.imagebind_model import ImageBindModel\n"
+        "load_and_transform_text(['a photo of a dog'], 'cpu')\n"
+        "with torch.device('meta'):\n"
+        "    ImageBindModel(modalities=['text'])",
+        ["timm", "sklearn", "numba"] + MEDIA_STACKS,
+    ),
+]
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+exec({statement!r})
+elapsed = time.perf_counter() - start
+modules = sorted(m for m in {modules!r} if m in sys.modules)
+print(json.dumps({{"elapsed": elapsed, "modules": modules}}))
+"""
+
+
+def run_case(statement, modules):
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(statement=statement, modules=modules)],
+        cwd=REPO_ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    failures = []
+    for name, statement, forbidden in CASES:
+        result = run_case(statement, HEAVY_MODULES)
+        loaded = sorted(set(result["modules"]) & set(forbidden))
+        print(
+            f"{name}: {result['elapsed']:.2f}s, "
+            f"loaded {', '.join(result['modules']) or 'nothing heavy'}"
+        )
+        if loaded:
+            failures.append(f"{name} imported {', '.join(loaded)}")
+
+    if failures:
+        sys.exit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
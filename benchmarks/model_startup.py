@@ -0,0 +1,58 @@
+"""
+Compares the time to build imagebind_huge and load its checkpoint with and
+without fast_load, and checks that both paths end up with the same weights.
+
+    python -m benchmarks.model_startup --modalities text
+"""
+import argparse
+import gc
+import time
+
+import torch
+
+from pegasus.ImageBind.models.imagebind_model import (
+    DEFAULT_CHECKPOINT_PATH,
+    imagebind_huge,
+)
+
+
+def time_load(checkpoint_path, modalities, fast_load):
+    gc.collect()
+    start = time.perf_counter()
+    model = imagebind_huge(
+        pretrained=True,
+        checkpoint_path=checkpoint_path,
+        modalities=modalities,
+        fast_load=fast_load,
+    )
+    return model, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT_PATH)
+    parser.add_argument("--modalities", nargs="+", default=None)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    # loads once so the file is in the page cache for both paths
+    reference, _ = time_load(args.checkpoint, args.modalities, fast_load=True)
+    reference = reference.state_dict()
+
+    for fast_load in (False, True):
+        timings = []
+        for _ in range(args.repeats):
+            model, elapsed = time_load(args.checkpoint, args.modalities, fast_load)
+            timings.append(elapsed)
+            state_dict = model.state_dict()
+            assert state_dict.keys() == reference.keys()
+            assert all(torch.equal(state_dict[k], reference[k]) for k in reference)
+            del model, state_dict
+        print(
+            f"fast_load={fast_load}: best {min(timings):.2f}s, "
+            f"mean {sum(timings) / len(timings):.2f}s over {args.repeats} runs"
+        )
+
+
+if __name__ == "__main__":
+    main()
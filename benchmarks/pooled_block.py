@@ -0,0 +1,76 @@
+"""
+Compares running the final block of a trunk for every token with running it
+for the pooled token only, checking that the embeddings match and timing both.
+
+    python -m benchmarks.pooled_block --modality vision --checkpoint .checkpoints/imagebind_huge.pth
+"""
+
+import argparse
+import time
+
+import torch
+
+from pegasus.ImageBind.data import load_and_transform_text
+from pegasus.ImageBind.models.imagebind_model import ModalityType, imagebind_huge
+
+TEXTS = [
+    "a dog",
+    "a low resolution cropped photo of a golden retriever",
+    "an espresso machine on a kitchen counter",
+    "snow leopard",
+]
+
+
+def make_inputs(modality, batch_size):
+    if modality == ModalityType.TEXT:
+        return load_and_transform_text(
+            [TEXTS[i % len(TEXTS)] for i in range(batch_size)], "cpu"
+        )
+    if modality == ModalityType.VISION:
+        return torch.randn(batch_size, 3, 224, 224)
+    if modality == ModalityType.AUDIO:
+        return torch.randn(batch_size, 3, 1, 128, 204)
+    raise ValueError(f"Unsupported modality: {modality}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--modality",
+        default=ModalityType.VISION,
+        choices=[ModalityType.VISION, ModalityType.TEXT, ModalityType.AUDIO],
+    )
+    parser.add_argument(
+        "--checkpoint", default=None, help="Random weights if not given"
+    )
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model = imagebind_huge(
+        pretrained=args.checkpoint is not None,
+        checkpoint_path=args.checkpoint,
+        modalities=[args.modality],
+        fast_load=True,
+    ).eval()
+    inputs = {args.modality: make_inputs(args.modality, args.batch_size)}
+
+    def embed(pool_final_block):
+        model.pool_final_block = pool_final_block
+        return model(inputs)[args.modality]
+
+    with torch.no_grad():
+        difference = (embed(False) - embed(True)).abs().max().item()
+        print(f"max abs difference over {args.batch_size} inputs: {difference:.2e}")
+        assert difference < 1e-4
+
+        for name, pool_final_block in (("all tokens", False), ("pooled token", True)):
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                embed(pool_final_block)
+            elapsed = (time.perf_counter() - start) / args.repeats
+            print(f"{name}: {elapsed * 1000:.1f} ms per batch of {args.batch_size}")
+
+
+if __name__ == "__main__":
+    main()
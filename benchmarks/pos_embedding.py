@@ -0,0 +1,72 @@
+"""
+Times the position embeddings of the vision and audio towers for inputs off
+their trained layout, interpolated on every call as before and served from the
+per-layout cache, checking that both match.
+
+    python -m benchmarks.pos_embedding --repeats 100
+"""
+
+import argparse
+import time
+
+import torch
+
+from pegasus.ImageBind.models.multimodal_preprocessors import (
+    SpatioTemporalPosEmbeddingHelper,
+    interpolate_pos_encoding,
+)
+
+# the trained layout and width of the imagebind_huge towers, and the layouts
+# of inputs at other sizes
+CASES = {
+    "vision 336x336": ((1, 16, 16), 1280, (3, 336, 336), (1, 24, 24)),
+    "vision 224x336": ((1, 16, 16), 1280, (3, 224, 336), (1, 16, 24)),
+    "audio target_length=400": ((12, 19), 768, (1, 128, 400), (12, 39)),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repeats", type=int, default=100)
+    args = parser.parse_args()
+
+    with torch.no_grad():
+        for name, (trained, dim, input_size, layout) in CASES.items():
+            num_patches = int(torch.tensor(trained).prod())
+            helper = SpatioTemporalPosEmbeddingHelper(
+                patches_layout=trained,
+                num_patches=num_patches,
+                num_cls_tokens=1,
+                embed_dim=dim,
+                learnable=True,
+            )
+            inputs = torch.empty(1, *input_size)
+            tokens = torch.empty(1, 1 + int(torch.tensor(layout).prod()), 1)
+
+            def interpolated():
+                return interpolate_pos_encoding(
+                    tokens.shape[1] - 1,
+                    helper.pos_embed,
+                    trained,
+                    input_shape=inputs.shape,
+                    target_layout=layout,
+                )
+
+            def cached():
+                return helper.get_pos_embedding(inputs, tokens, layout)
+
+            assert torch.equal(interpolated(), cached())
+            timings = []
+            for embed in (interpolated, cached):
+                start = time.perf_counter()
+                for _ in range(args.repeats):
+                    embed()
+                timings.append((time.perf_counter() - start) / args.repeats * 1e6)
+            print(
+                f"{name}: {timings[0]:.0f} us interpolated, "
+                f"{timings[1]:.1f} us cached per batch"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Compares embedding short labels with and without packing several of them per
+text row, checking that the embeddings match and timing both.
+
+    python -m benchmarks.text_packing --checkpoint .checkpoints/imagebind_huge.pth
+"""
+import argparse
+import random
+import time
+
+import torch
+
+from pegasus.ImageBind.data import load_and_transform_text
+from pegasus.ImageBind.models.imagebind_model import ModalityType, imagebind_huge
+
+WORDS = (
+    "dog cat car tree house beach mountain river city night red blue green "
+    "small large old new running sleeping flying photo painting sketch"
+).split()
+
+
+def embed(model, tokens, pack_sequences):
+    preprocessor = model.modality_preprocessors[ModalityType.TEXT]
+    preprocessor.pack_sequences = pack_sequences
+    with torch.no_grad():
+        return model({ModalityType.TEXT: tokens})[ModalityType.TEXT]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--checkpoint", default=None, help="Random weights if not given"
+    )
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model = imagebind_huge(
+        pretrained=args.checkpoint is not None,
+        checkpoint_path=args.checkpoint,
+        modalities=[ModalityType.TEXT],
+        fast_load=True,
+    ).eval()
+    random.seed(0)
+    labels = [
+        " ".join(random.choices(WORDS, k=random.randint(1, 4)))
+        for _ in range(args.batch_size)
+    ]
+    tokens = load_and_transform_text(labels, "cpu")
+
+    unpacked = embed(model, tokens, pack_sequences=False)
+    packed = embed(model, tokens, pack_sequences=True)
+    difference = (unpacked - packed).abs().max().item()
+    print(f"max abs difference over {len(labels)} labels: {difference:.2e}")
+    assert torch.allclose(unpacked, packed, atol=1e-5)
+
+    rows = model.modality_preprocessors[ModalityType.TEXT].pack(tokens)[0].shape
+    print(f"{len(labels)} labels packed into {rows[0]} rows of {rows[1]} tokens")
+    for pack_sequences in (False, True):
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            embed(model, tokens, pack_sequences)
+        elapsed = (time.perf_counter() - start) / args.repeats
+        print(f"pack_sequences={pack_sequences}: {elapsed * 1000:.1f} ms per batch")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Compares embedding templated prompts in full with embedding them over a
+registered shared prefix, checking that the embeddings match and timing both.
+
+    python -m benchmarks.text_prefix --checkpoint .checkpoints/imagebind_huge.pth
+"""
+import argparse
+import time
+
+import torch
+
+from pegasus.ImageBind.data import (
+    load_and_transform_text,
+    load_and_transform_text_with_prefix,
+)
+from pegasus.ImageBind.models.imagebind_model import ModalityType, imagebind_huge
+
+PREFIX = "a low resolution cropped photo of a"
+LABELS = [
+    "dog",
+    "cat",
+    "golden retriever",
+    "fire truck",
+    "hot air balloon",
+    "tabby cat sleeping",
+    "snow leopard",
+    "espresso machine",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--checkpoint", default=None, help="Random weights if not given"
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model = imagebind_huge(
+        pretrained=args.checkpoint is not None,
+        checkpoint_path=args.checkpoint,
+        modalities=[ModalityType.TEXT],
+        fast_load=True,
+    ).eval()
+    labels = [LABELS[i % len(LABELS)] for i in range(args.batch_size)]
+    prompts = load_and_transform_text([f"{PREFIX} {label}" for label in labels], "cpu")
+    prefix, suffixes = load_and_transform_text_with_prefix(PREFIX, labels, "cpu")
+    assert torch.equal(prompts[:, : len(prefix)], prefix.expand(len(labels), -1))
+    model.register_text_prefix("photo", prefix)
+
+    def full():
+        return model({ModalityType.TEXT: prompts})[ModalityType.TEXT]
+
+    def with_prefix():
+        return model.embed_text_with_prefix("photo", suffixes)
+
+    with torch.no_grad():
+        difference = (full() - with_prefix()).abs().max().item()
+        print(f"max abs difference over {len(labels)} prompts: {difference:.2e}")
+        assert difference < 1e-5
+
+        for name, embed in (("full prompts", full), ("shared prefix", with_prefix)):
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                embed()
+            elapsed = (time.perf_counter() - start) / args.repeats
+            print(f"{name}: {elapsed * 1000:.1f} ms per batch of {len(labels)}")
+
+
+if __name__ == "__main__":
+    main()
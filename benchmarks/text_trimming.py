@@ -0,0 +1,76 @@
+"""
+Compares the text tower with and without trimming the padding of each batch,
+checking that the embeddings match and timing both on short queries.
+
+    python -m benchmarks.text_trimming --checkpoint .checkpoints/imagebind_huge.pth
+"""
+import argparse
+import time
+
+import torch
+
+from pegasus.ImageBind.data import load_and_transform_text
+from pegasus.ImageBind.models.imagebind_model import ModalityType, imagebind_huge
+
+QUERIES = [
+    "a dog",
+    "a photo of a cat sleeping on a sofa",
+    "red sports car",
+    "people walking on a beach at sunset",
+    "a bowl of ramen with chopsticks",
+    "snow covered mountains under a clear blue sky",
+    "a child playing the violin",
+    "aerial view of a city at night",
+]
+
+
+def embed(model, tokens, trim_padding):
+    model.modality_preprocessors[ModalityType.TEXT].trim_padding = trim_padding
+    with torch.no_grad():
+        return model({ModalityType.TEXT: tokens})[ModalityType.TEXT]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--checkpoint", default=None, help="Random weights if not given"
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    model = imagebind_huge(
+        pretrained=args.checkpoint is not None,
+        checkpoint_path=args.checkpoint,
+        modalities=[ModalityType.TEXT],
+        fast_load=True,
+    ).eval()
+    texts = [QUERIES[i % len(QUERIES)] for i in range(args.batch_size)]
+    tokens = load_and_transform_text(texts, "cpu")
+    # one long text so the batch also covers a full context
+    long_tokens = load_and_transform_text([" ".join(QUERIES * 4)] + texts[1:], "cpu")
+
+    for batch in (tokens, long_tokens):
+        full = embed(model, batch, trim_padding=False)
+        trimmed = embed(model, batch, trim_padding=True)
+        print(
+            f"max abs difference over {len(batch)} texts: "
+            f"{(full - trimmed).abs().max().item():.2e}"
+        )
+        assert torch.allclose(full, trimmed, atol=1e-5)
+
+    length = int(tokens.argmax(dim=-1).max()) + 1
+    for trim_padding in (False, True):
+        embed(model, tokens, trim_padding)
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            embed(model, tokens, trim_padding)
+        elapsed = (time.perf_counter() - start) / args.repeats
+        print(
+            f"trim_padding={trim_padding} ({length if trim_padding else 77} tokens): "
+            f"{elapsed * 1000:.1f} ms per batch of {len(tokens)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
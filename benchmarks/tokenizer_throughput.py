@@ -0,0 +1,71 @@
+"""
+Measures the tokens per second of SimpleTokenizer with the Python and the numba
+bpe merges, with a cold and a warm word cache, and checks that both produce the
+same token ids.
+
+    python -m benchmarks.tokenizer_throughput --corpus corpus.txt
+"""
+import argparse
+import glob
+import os
+import time
+
+from pegasus.ImageBind.data import BPE_PATH
+from pegasus.ImageBind.models.multimodal_preprocessors import SimpleTokenizer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_corpus(paths, repeat):
+    if not paths:
+        paths = sorted(
+            glob.glob(os.path.join(REPO_ROOT, "**", "*.md"), recursive=True)
+            + glob.glob(os.path.join(REPO_ROOT, "**", "*.py"), recursive=True)
+        )
+    lines = []
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            lines.extend(line.strip() for line in f if line.strip())
+    return lines * repeat
+
+
+def encode_all(tokenizer, lines):
+    start = time.perf_counter()
+    ids = [tokenizer.encode(line) for line in lines]
+    return ids, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--corpus", nargs="*", help="Text files, the repo's sources by default"
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    lines = load_corpus(args.corpus, args.repeat)
+    reference = None
+    for use_numba in (False, True):
+        for cache in ("cold", "warm"):
+            # a cache of 0 words merges every word again
+            tokenizer = SimpleTokenizer(
+                BPE_PATH,
+                cache_size=0 if cache == "cold" else None,
+                use_numba=use_numba,
+            )
+            # compiles the kernel and, for a warm run, fills the cache
+            encode_all(tokenizer, lines if cache == "warm" else lines[:10])
+            ids, elapsed = encode_all(tokenizer, lines)
+            if reference is None:
+                reference = ids
+            assert ids == reference, "token ids differ between backends"
+            n_tokens = sum(len(i) for i in ids)
+            print(
+                f"{'numba' if use_numba else 'python'} {cache} cache: "
+                f"{n_tokens / elapsed:,.0f} tokens/s "
+                f"({n_tokens:,} tokens in {elapsed:.2f}s)"
+            )
+
+
+if __name__ == "__main__":
+    main()
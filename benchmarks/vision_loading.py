@@ -0,0 +1,136 @@
+"""
+Compares the vision loader with the previous one, which rebuilt its transforms
+for every image and fully decoded each file one at a time, reporting how far
+the inputs differ and the images per second of both, for file paths and for
+in-memory encoded bytes and decoded arrays.
+
+    python -m benchmarks.vision_loading --images "photos/*.jpg"
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from pegasus.ImageBind.data import load_and_transform_vision_data
+
+
+def reference_loader(image_paths, device):
+    image_ouputs = []
+    for image_path in image_paths:
+        data_transform = transforms.Compose(
+            [
+                transforms.Resize(
+                    224, interpolation=transforms.InterpolationMode.BICUBIC
+                ),
+                transforms.CenterCrop(224),
+                transforms.ToTensor(),
+                transforms.Normalize(
+                    mean=(0.48145466, 0.4578275, 0.40821073),
+                    std=(0.26862954, 0.26130258, 0.27577711),
+                ),
+            ]
+        )
+        with open(image_path, "rb") as fopen:
+            image = Image.open(fopen).convert("RGB")
+        image_ouputs.append(data_transform(image).to(device))
+    return torch.stack(image_ouputs, dim=0)
+
+
+def synthetic_images(directory, count, size):
+    """Writes smooth noisy photos-like JPEGs, standing in for real photos"""
+    rng = np.random.default_rng(0)
+    width, height = size
+    paths = []
+    for i in range(count):
+        y, x = np.mgrid[0:height, 0:width]
+        phase = rng.uniform(0, 2 * np.pi, 3)
+        image = np.stack(
+            [
+                127 + 100 * np.sin(x / (40 + 10 * c) + y / 70 + phase[c])
+                for c in range(3)
+            ],
+            axis=-1,
+        )
+        image += rng.normal(0, 8, image.shape)
+        path = os.path.join(directory, f"{i}.jpg")
+        Image.fromarray(image.clip(0, 255).astype(np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def images_per_second(loader, paths, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        loader(paths, "cpu")
+    return repeats * len(paths) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--images", help="A glob of images, synthetic if not given")
+    parser.add_argument("--count", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.images:
+            paths = sorted(glob.glob(args.images))[: args.count]
+        else:
+            paths = synthetic_images(directory, args.count, (3000, 2000))
+
+        reference = reference_loader(paths, "cpu")
+        for name, kwargs in (
+            ("full decode", {"draft": False}),
+            ("draft decode", {"draft": True}),
+        ):
+            inputs = load_and_transform_vision_data(paths, "cpu", **kwargs)
+            difference = (inputs - reference).abs()
+            print(
+                f"{name}: max abs difference {difference.max().item():.3f}, "
+                f"mean {difference.mean().item():.4f} (normalized units)"
+            )
+            if not kwargs["draft"]:
+                assert torch.equal(inputs, reference)
+
+        blobs = []
+        for path in paths:
+            with open(path, "rb") as f:
+                blobs.append(f.read())
+        arrays = [np.asarray(Image.open(path).convert("RGB")) for path in paths]
+        for name, items in (("bytes", blobs), ("arrays", arrays)):
+            inputs = load_and_transform_vision_data(items, "cpu")
+            difference = (inputs - reference).abs()
+            print(
+                f"{name}: max abs difference {difference.max().item():.3f}, "
+                f"mean {difference.mean().item():.4f} (normalized units)"
+            )
+
+        loaders = {
+            "previous loader": reference_loader,
+            "full decode, parallel": lambda p, d: load_and_transform_vision_data(
+                p, d, draft=False
+            ),
+            "draft decode, serial": lambda p, d: load_and_transform_vision_data(
+                p, d, parallel=False
+            ),
+            "draft decode, parallel": load_and_transform_vision_data,
+        }
+        for name, loader in loaders.items():
+            rate = images_per_second(loader, paths, args.repeats)
+            print(f"{name}: {rate:.1f} images/s")
+        for name, items in (("in-memory bytes", blobs), ("decoded arrays", arrays)):
+            rate = images_per_second(
+                load_and_transform_vision_data, items, args.repeats
+            )
+            print(f"{name}: {rate:.1f} images/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compares the vision stem on still images, padded into 2-frame clips for the
+Conv3d, with the folded Conv2d it now runs, checking that the patch embeddings
+match and timing both.
+
+    python -m benchmarks.vision_stem --batch-size 32
+"""
+
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from pegasus.ImageBind.models.multimodal_preprocessors import (
+    PadIm2Video,
+    PatchEmbedGeneric,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--embed-dim", type=int, default=1280)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    # the stem of imagebind_huge
+    stem = PatchEmbedGeneric(
+        proj_stem=[
+            PadIm2Video(pad_type="repeat", ntimes=2),
+            nn.Conv3d(
+                in_channels=3,
+                kernel_size=(2, 14, 14),
+                out_channels=args.embed_dim,
+                stride=(2, 14, 14),
+                bias=False,
+            ),
+        ]
+    ).eval()
+    assert stem.image_fold == "repeat"
+    images = torch.randn(args.batch_size, 3, 224, 224).contiguous(
+        memory_format=torch.channels_last
+    )
+
+    def padded():
+        return stem.proj(images).flatten(2).transpose(1, 2)
+
+    def folded():
+        return stem(images)
+
+    with torch.no_grad():
+        difference = (padded() - folded()).abs().max().item()
+        print(f"max abs difference over {len(images)} images: {difference:.2e}")
+        assert difference < 1e-4
+
+        for name, embed in (("padded Conv3d", padded), ("folded Conv2d", folded)):
+            embed()
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                embed()
+            elapsed = (time.perf_counter() - start) / args.repeats
+            print(f"{name}: {elapsed * 1000:.1f} ms per batch of {len(images)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,29 +6,53 @@
 # LICENSE file in the root directory of this source tree.
 
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
 import torch
 import torch.nn as nn
-import torchaudio
 import logging
 
 # from ..multimodal_preprocessors import SimpleTokenizer
 from .models.multimodal_preprocessors import SimpleTokenizer
-from PIL import Image
-from pytorchvideo import transforms as pv_transforms
-from pytorchvideo.data.clip_sampling import ConstantClipsPerVideoSampler
-from pytorchvideo.data.encoded_video import EncodedVideo
 
-from torchvision import transforms
-from torchvision.transforms._transforms_video import NormalizeVideo
+# The image, audio and video stacks (PIL, torchvision, torchaudio, pytorchvideo)
+# are imported by the loaders that need them, so text-only use never loads them.
 
 DEFAULT_AUDIO_FRAME_SHIFT_MS = 10  # in milliseconds
 
-BPE_PATH = "./pegasus/ImageBind/bpe_simple_vocab_16e6.txt.gz"
+BPE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "bpe_simple_vocab_16e6.txt.gz"
+)
+
+
+def get_tokenizer(bpe_path=BPE_PATH, use_numba=None):
+    """
+    Return the process-wide tokenizer, built on first use
+
+    use_numba turns on the numba merge kernel of SimpleTokenizer. It defaults
+    to the PEGASUS_USE_NUMBA environment variable, which also reaches the
+    tokenizers of worker processes and of load_and_transform_text
+    """
+    if use_numba is None:
+        use_numba = os.environ.get("PEGASUS_USE_NUMBA", "").lower() in {
+            "1",
+            "true",
+            "yes",
+        }
+    return _get_tokenizer(bpe_path, use_numba)
+
+
+@lru_cache(maxsize=None)
+def _get_tokenizer(bpe_path, use_numba):
+    return SimpleTokenizer(bpe_path=bpe_path, use_numba=use_numba)
 
 
 def waveform2melspec(waveform, sample_rate, num_mel_bins, target_length):
     # Based on https://github.com/YuanGongND/ast/blob/d7d8b4b8e06cdaeb6c843cdb38794c1c7692234c/src/dataloader.py#L102
+    import torchaudio
+
     waveform -= waveform.mean()
     fbank = torchaudio.compliance.kaldi.fbank(
         waveform,
@@ -77,40 +101,263 @@ def get_clip_timepoints(clip_sampler, duration):
     return all_clips_timepoints
 
 
-def load_and_transform_vision_data(image_paths, device):
-    if image_paths is None:
-        return None
+VISION_SIZE = 224
+VISION_MEAN = (0.48145466, 0.4578275, 0.40821073)
+VISION_STD = (0.26862954, 0.26130258, 0.27577711)
 
-    image_ouputs = []
-    for image_path in image_paths:
-        data_transform = transforms.Compose(
-            [
-                transforms.Resize(
-                    224, interpolation=transforms.InterpolationMode.BICUBIC
-                ),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize(
-                    mean=(0.48145466, 0.4578275, 0.40821073),
-                    std=(0.26862954, 0.26130258, 0.27577711),
-                ),
-            ]
+# shared by the vision loaders of this process, started on first use
+_decode_pool = None
+
+
+@lru_cache(maxsize=None)
+def get_vision_transform(size=VISION_SIZE):
+    """Return the resize, crop and normalize pipeline of the vision tower"""
+    from torchvision import transforms
+
+    return transforms.Compose(
+        [
+            transforms.Resize(size, interpolation=transforms.InterpolationMode.BICUBIC),
+            transforms.CenterCrop(size),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=VISION_MEAN, std=VISION_STD),
+        ]
+    )
+
+
+def _reset_decode_pool():
+    # the threads of the pool do not survive a fork
+    global _decode_pool
+    _decode_pool = None
+
+
+if hasattr(os, "register_at_fork"):
+    # Windows has no fork, and no register_at_fork
+    os.register_at_fork(after_in_child=_reset_decode_pool)
+
+
+def _get_decode_pool():
+    global _decode_pool
+    if _decode_pool is None:
+        _decode_pool = ThreadPoolExecutor(
+            max_workers=min(8, os.cpu_count() or 1),
+            thread_name_prefix="pegasus-decode",
         )
-        with open(image_path, "rb") as fopen:
-            image = Image.open(fopen).convert("RGB")
+    return _decode_pool
+
+
+def load_image(image_path, draft=True, size=VISION_SIZE):
+    """
+    Decodes an image file into the normalized 3 x size x size vision input
+
+    With draft, JPEGs are decoded straight at the smallest of their 1/2, 1/4
+    and 1/8 scales whose sides are still at least size, which makes decoding
+    large photos several times faster. The output then differs slightly from
+    a full decode, as with any change of resampling.
+    """
+    from PIL import Image
+
+    with open(image_path, "rb") as fopen:
+        image = Image.open(fopen)
+        if draft:
+            image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+    return get_vision_transform(size)(image)
+
+
+def decode_image(image):
+    """
+    Converts an in-memory image into a 3 x H x W uint8 tensor
+
+    Args:
+        image: Encoded image bytes, an H x W or H x W x C uint8 array, or an
+            H x W or C x H x W uint8 tensor. Grayscale is expanded to RGB and
+            alpha is dropped.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        from torchvision.io import ImageReadMode
+        from torchvision.io import decode_image as decode
+
+        try:
+            return decode(
+                torch.frombuffer(bytearray(image), dtype=torch.uint8),
+                mode=ImageReadMode.RGB,
+            )
+        except RuntimeError:
+            # formats torchvision cannot decode, e.g. BMP or TIFF
+            import io
+
+            import numpy as np
+            from PIL import Image
+
+            image = np.array(Image.open(io.BytesIO(image)).convert("RGB"))
+
+    if not isinstance(image, torch.Tensor):
+        if not image.flags.writeable:
+            # torch cannot share read-only memory, e.g. np.asarray of a PIL image
+            image = image.copy()
+        image = torch.from_numpy(image)
+        if image.ndim == 3:
+            image = image.permute(2, 0, 1)
+    if image.dtype != torch.uint8:
+        raise ValueError(f"Expected a uint8 image, got {image.dtype}")
+    if image.ndim == 2:
+        image = image.unsqueeze(0)
+    if image.ndim != 3 or image.shape[0] not in (1, 3, 4):
+        raise ValueError(f"Invalid image shape: {tuple(image.shape)}")
+    if image.shape[0] == 1:
+        return image.expand(3, -1, -1)
+    return image[:3]
+
+
+def transform_images(images, size=VISION_SIZE):
+    """
+    Resizes, center-crops and normalizes uint8 images as batched tensor ops
 
-        image = data_transform(image).to(device)
-        image_ouputs.append(image)
-    return torch.stack(image_ouputs, dim=0)
+    Images of the same size are stacked and resized in a single call, with the
+    bicubic antialiased resampling and short side sizing of
+    get_vision_transform.
+
+    Args:
+        images: A list of 3 x H x W uint8 tensors
+    Returns:
+        the N x 3 x size x size float32 batch, in channels_last layout
+    """
+    import torch.nn.functional as F
+
+    batch = torch.empty(len(images), 3, size, size).to(
+        memory_format=torch.channels_last
+    )
+    mean = torch.tensor(VISION_MEAN).view(1, 3, 1, 1) * 255
+    std = torch.tensor(VISION_STD).view(1, 3, 1, 1) * 255
+
+    groups = {}
+    for index, image in enumerate(images):
+        groups.setdefault(tuple(image.shape[-2:]), []).append(index)
+    for (height, width), indices in groups.items():
+        # stacking H x W x C views yields channels_last without a strided copy
+        # for arrays, which are H x W x C in memory
+        group = torch.stack([images[index].permute(1, 2, 0) for index in indices])
+        group = group.permute(0, 3, 1, 2)
+        if height <= width:
+            resized = (size, int(size * width / height))
+        else:
+            resized = (int(size * height / width), size)
+        if resized != (height, width):
+            # resampling uint8 keeps the rounding of PIL and takes the
+            # vectorized channels_last kernels, several times faster than float
+            group = F.interpolate(
+                group,
+                size=resized,
+                mode="bicubic",
+                align_corners=False,
+                antialias=True,
+            )
+        top = int(round((resized[0] - size) / 2.0))
+        left = int(round((resized[1] - size) / 2.0))
+        group = group[..., top : top + size, left : left + size]
+        batch[indices] = (group.float() - mean) / std
+    return batch
+
+
+def _map_images(function, images, parallel):
+    if parallel and len(images) > 1:
+        return list(_get_decode_pool().map(function, images))
+    return [function(image) for image in images]
+
+
+def load_and_transform_vision_data(
+    images, device, draft=True, parallel=True, size=VISION_SIZE
+):
+    """
+    Loads a batch of images, decoding them on a shared thread pool unless
+    parallel is False
+
+    Args:
+        images: File paths, handled by load_image (see it for draft), or
+            in-memory images: encoded bytes, uint8 arrays or uint8 tensors,
+            see decode_image. In-memory images are never written to disk and
+            are resized, cropped and normalized together by transform_images.
+        device: The device of the returned batch
+        size: The side of the square crops. The vision tower interpolates its
+            position embeddings for sizes other than the 224 it was trained at.
+    Returns:
+        the N x 3 x size x size batch, in channels_last layout
+    """
+    if images is None:
+        return None
+
+    is_path = [isinstance(image, (str, os.PathLike)) for image in images]
+    outputs = [None] * len(images)
+    paths = [index for index, path in enumerate(is_path) if path]
+    if paths:
+        load = partial(load_image, draft=draft, size=size)
+        loaded = _map_images(load, [images[i] for i in paths], parallel)
+        for index, image in zip(paths, loaded):
+            outputs[index] = image
+    arrays = [index for index, path in enumerate(is_path) if not path]
+    if arrays:
+        decoded = _map_images(decode_image, [images[i] for i in arrays], parallel)
+        for index, image in zip(arrays, transform_images(decoded, size)):
+            outputs[index] = image
+
+    batch = torch.stack(outputs, dim=0).to(device)
+    return batch.contiguous(memory_format=torch.channels_last)
 
 
 def load_and_transform_text(text, device):
     if text is None:
         return None
-    tokenizer = SimpleTokenizer(bpe_path=BPE_PATH)
-    tokens = [tokenizer(t).unsqueeze(0).to(device) for t in text]
-    tokens = torch.cat(tokens, dim=0)
-    return tokens
+    return get_tokenizer().tokenize_batch(text).to(device)
+
+
+def split_text_windows(text, context_length=77, overlap=16):
+    """
+    Splits a text into overlapping windows of tokens that each fit in the
+    context of the text tower, instead of truncating it
+
+    Returns:
+        the W x context_length token ids of the windows, each framed by the
+        start and end of text tokens, and the number of text tokens in each
+    """
+    size = context_length - 2
+    if not 0 <= overlap < size:
+        raise ValueError(f"overlap should be between 0 and {size - 1}")
+    tokenizer = get_tokenizer()
+    ids = tokenizer.encode(text)
+    starts = range(0, max(len(ids) - overlap, 1), size - overlap)
+    tokens = torch.zeros(len(starts), context_length, dtype=torch.long)
+    lengths = []
+    for row, start in enumerate(starts):
+        window = ids[start : start + size]
+        window = (
+            [tokenizer.encoder["<|startoftext|>"]]
+            + window
+            + [tokenizer.encoder["<|endoftext|>"]]
+        )
+        tokens[row, : len(window)] = torch.tensor(window)
+        lengths.append(len(window) - 2)
+    return tokens, lengths
+
+
+def load_and_transform_text_with_prefix(prefix, text, device, context_length=77):
+    """
+    Tokenizes prompts made of a shared prefix followed by each text, for
+    ImageBindModel.register_text_prefix and embed_text_with_prefix
+
+    The prefix should end at a word boundary, e.g. "a photo of a" for texts
+    "dog" and "cat", so the tokens match those of the whole prompts.
+
+    Returns:
+        the 1D prefix token ids, starting with the start of text token, and the
+        N x (context_length - prefix length) token ids of the texts, each ending
+        with the end of text token unless the prompt is truncated
+    """
+    tokenizer = get_tokenizer()
+    sot_token = tokenizer.encoder["<|startoftext|>"]
+    prefix_tokens = torch.tensor([sot_token] + tokenizer.encode(prefix))
+    text_tokens = tokenizer.tokenize_batch(text, context_length + 1)[:, 1:]
+    text_tokens = text_tokens[:, : context_length - len(prefix_tokens)]
+    return prefix_tokens.to(device), text_tokens.to(device)
 
 
 def load_and_transform_audio_data(
@@ -127,6 +374,10 @@ def load_and_transform_audio_data(
     if audio_paths is None:
         return None
 
+    import torchaudio
+    from pytorchvideo.data.clip_sampling import ConstantClipsPerVideoSampler
+    from torchvision import transforms
+
     audio_outputs = []
     clip_sampler = ConstantClipsPerVideoSampler(
         clip_duration=clip_duration, clips_per_video=clips_per_video
@@ -289,7 +540,9 @@ class SpatialCrop(nn.Module):
                 res.append(uniform_crop(video, self.crop_size, spatial_idx)[0])
             if not self.flipped_crops_to_ext:
                 continue
-            flipped_video = transforms.functional.hflip(video)
+            from torchvision.transforms.functional import hflip
+
+            flipped_video = hflip(video)
             for spatial_idx in self.flipped_crops_to_ext:
                 res.append(uniform_crop(flipped_video, self.crop_size, spatial_idx)[0])
         return res
@@ -305,6 +558,12 @@ def load_and_transform_video_data(
     if video_paths is None:
         return None
 
+    from pytorchvideo import transforms as pv_transforms
+    from pytorchvideo.data.clip_sampling import ConstantClipsPerVideoSampler
+    from pytorchvideo.data.encoded_video import EncodedVideo
+    from torchvision import transforms
+    from torchvision.transforms._transforms_video import NormalizeVideo
+
     video_outputs = []
     video_transform = transforms.Compose(
         [
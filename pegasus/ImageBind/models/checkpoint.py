@@ -0,0 +1,98 @@
+"""
+Per-modality safetensors checkpoints
+
+The original checkpoint is a single pickle that torch.load reads into private
+memory in every process. convert_checkpoint splits it once into one safetensors
+shard per modality, and load_shards memory-maps the shards of the requested
+modalities, so the weights are served from the page cache and shared by every
+process that loads them.
+
+    python -m pegasus.ImageBind.models.checkpoint .checkpoints/imagebind_huge.pth .checkpoints/imagebind_huge
+"""
+
+import argparse
+import os
+from collections import defaultdict
+
+import torch
+
+SHARD_EXTENSION = ".safetensors"
+
+
+def _import_safetensors():
+    try:
+        import safetensors
+        import safetensors.torch
+    except ImportError:
+        raise ImportError(
+            "Sharded checkpoints need safetensors, install it with "
+            "`pip install safetensors`"
+        )
+    return safetensors
+
+
+def shard_path(shard_dir, modality):
+    """Return the path of the shard holding the weights of a modality"""
+    return os.path.join(shard_dir, modality + SHARD_EXTENSION)
+
+
+def is_shard_dir(path):
+    """Whether a checkpoint path is a directory of per-modality shards"""
+    return os.path.isdir(path)
+
+
+def convert_checkpoint(checkpoint_path, shard_dir):
+    """
+    Splits an ImageBindModel checkpoint into per-modality safetensors shards
+
+    Args:
+        checkpoint_path (str): The .pth checkpoint to convert
+        shard_dir (str): The directory the shards are written to
+    Returns:
+        The paths of the written shards.
+    """
+    safetensors = _import_safetensors()
+    state_dict = torch.load(checkpoint_path, map_location="cpu")
+
+    shards = defaultdict(dict)
+    for key, value in state_dict.items():
+        # safetensors refuses shared or non-contiguous storage
+        shards[key.split(".")[1]][key] = value.contiguous().clone()
+
+    os.makedirs(shard_dir, exist_ok=True)
+    paths = []
+    for modality, shard in shards.items():
+        path = shard_path(shard_dir, modality)
+        safetensors.torch.save_file(shard, path)
+        paths.append(path)
+    return paths
+
+
+def load_shards(shard_dir, modalities):
+    """
+    Memory-maps the shards of the given modalities into a single state dict
+
+    The tensors are backed by the shard files rather than copied, so they stay
+    in the page cache and are shared between processes until they are written.
+    """
+    safetensors = _import_safetensors()
+    state_dict = {}
+    for modality in modalities:
+        path = shard_path(shard_dir, modality)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Missing {modality} shard: {path}")
+        with safetensors.safe_open(path, framework="pt") as f:
+            for key in f.keys():
+                state_dict[key] = f.get_tensor(key)
+    return state_dict
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split an ImageBind checkpoint into per-modality safetensors shards"
+    )
+    parser.add_argument("checkpoint", help="The .pth checkpoint to convert")
+    parser.add_argument("shard_dir", help="The directory to write the shards to")
+    args = parser.parse_args()
+    for path in convert_checkpoint(args.checkpoint, args.shard_dir):
+        print(path)
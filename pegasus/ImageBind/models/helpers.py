@@ -112,6 +112,28 @@ class QuickGELU(nn.Module):
         return x * torch.sigmoid(1.702 * x)
 
 
+class DropPath(nn.Module):
+    """
+    Drops the residual branch of whole samples, as timm's DropPath, without
+    importing timm and the torchvision stack it pulls in
+    """
+
+    def __init__(self, drop_prob: float = 0.0) -> None:
+        super().__init__()
+        self.drop_prob = drop_prob
+
+    def forward(self, x):
+        if self.drop_prob == 0.0 or not self.training:
+            return x
+        keep_prob = 1 - self.drop_prob
+        shape = (x.shape[0],) + (1,) * (x.ndim - 1)
+        mask = x.new_empty(shape).bernoulli_(keep_prob)
+        return x * mask.div_(keep_prob)
+
+    def extra_repr(self):
+        return f"drop_prob={round(self.drop_prob, 3):0.3f}"
+
+
 class SelectElement(nn.Module):
     def __init__(self, index) -> None:
         super().__init__()
@@ -131,10 +153,13 @@ class SelectEOSAndProject(nn.Module):
         super().__init__()
         self.proj = proj
 
-    def forward(self, x, seq_len):
+    def forward(self, x, seq_len, rows=None):
         assert x.ndim == 3
         # x is of shape B x L x D
         # take features from the eot embedding (eot_token is the highest number in each sequence)
-        x = x[torch.arange(x.shape[0]), seq_len]
+        # rows gives the row of each sequence when several are packed per row
+        if rows is None:
+            rows = torch.arange(x.shape[0])
+        x = x[rows, seq_len]
         x = self.proj(x)
         return x
@@ -6,6 +6,7 @@
 # LICENSE file in the root directory of this source tree.
 
 
+import contextlib
 import os
 from functools import partial
 from types import SimpleNamespace
@@ -14,6 +15,7 @@ import torch
 import torch.nn as nn
 
 
+from .checkpoint import is_shard_dir, load_shards
 from .helpers import (
     EinOpsRearrange,
     LearnableLogitScaling,
@@ -32,7 +34,16 @@ from .multimodal_preprocessors import (
     ThermalPreprocessor,
 )
 
-from .transformer import MultiheadAttention, SimpleTransformer
+from .transformer import (
+    FusedMultiheadAttention,
+    MultiheadAttention,
+    SimpleTransformer,
+)
+
+DEFAULT_CHECKPOINT_PATH = ".checkpoints/imagebind_huge.pth"
+CHECKPOINT_URL = "https://dl.fbaipublicfiles.com/imagebind/imagebind_huge.pth"
+# the size of the joint embedding space of imagebind_huge
+EMBED_DIM = 1024
 
 
 ModalityType = SimpleNamespace(
@@ -80,8 +91,27 @@ class ImageBindModel(nn.Module):
         imu_num_blocks=6,
         imu_num_heads=8,
         imu_drop_path=0.7,
+        modalities=None,
+        pool_final_block=True,
+        fused_attention=True,
+        pack_text=False,
     ):
         super().__init__()
+        # batch-first SDPA trunks, with the parameters of the nn.MultiheadAttention ones
+        self.fused_attention = fused_attention
+        # several short texts per text trunk row, see TextPreprocessor.pack
+        self.pack_text = pack_text
+        # the final block of each trunk only computes the token its head reads
+        self.pool_final_block = pool_final_block
+
+        all_modalities = list(vars(ModalityType).values())
+        if modalities is None:
+            modalities = all_modalities
+        unknown = [m for m in modalities if m not in all_modalities]
+        if unknown:
+            raise ValueError(f"Unknown modalities: {unknown}")
+        # only the towers of these modalities are built
+        self.modalities = [m for m in all_modalities if m in modalities]
 
         self.modality_preprocessors = self._create_modality_preprocessors(
             video_frames,
@@ -139,6 +169,9 @@ class ImageBindModel(nn.Module):
             out_embed_dim
         )
 
+        # name -> prefix token ids and their cached keys and values per block
+        self._text_prefixes = {}
+
     def _create_modality_preprocessors(
         self,
         video_frames=2,
@@ -156,120 +189,126 @@ class ImageBindModel(nn.Module):
         thermal_kernel_size=16,
         imu_embed_dim=512,
     ):
-        rgbt_stem = PatchEmbedGeneric(
-            proj_stem=[
-                PadIm2Video(pad_type="repeat", ntimes=2),
-                nn.Conv3d(
-                    in_channels=3,
-                    kernel_size=kernel_size,
-                    out_channels=vision_embed_dim,
-                    stride=kernel_size,
-                    bias=False,
-                ),
-            ]
-        )
-        rgbt_preprocessor = RGBDTPreprocessor(
-            img_size=[3, video_frames, 224, 224],
-            num_cls_tokens=1,
-            pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
-            rgbt_stem=rgbt_stem,
-            depth_stem=None,
-        )
-
-        text_preprocessor = TextPreprocessor(
-            context_length=77,
-            vocab_size=49408,
-            embed_dim=text_embed_dim,
-            causal_masking=True,
-        )
-
-        audio_stem = PatchEmbedGeneric(
-            proj_stem=[
-                nn.Conv2d(
-                    in_channels=1,
-                    kernel_size=audio_kernel_size,
-                    stride=audio_stride,
-                    out_channels=audio_embed_dim,
-                    bias=False,
-                ),
-            ],
-            norm_layer=nn.LayerNorm(normalized_shape=audio_embed_dim),
-        )
-        audio_preprocessor = AudioPreprocessor(
-            img_size=[1, audio_num_mel_bins, audio_target_len],
-            num_cls_tokens=1,
-            pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
-            audio_stem=audio_stem,
-        )
-
-        depth_stem = PatchEmbedGeneric(
-            [
-                nn.Conv2d(
-                    kernel_size=depth_kernel_size,
-                    in_channels=1,
-                    out_channels=depth_embed_dim,
-                    stride=depth_kernel_size,
-                    bias=False,
-                ),
-            ],
-            norm_layer=nn.LayerNorm(normalized_shape=depth_embed_dim),
-        )
-
-        depth_preprocessor = RGBDTPreprocessor(
-            img_size=[1, 224, 224],
-            num_cls_tokens=1,
-            pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
-            rgbt_stem=None,
-            depth_stem=depth_stem,
-        )
-
-        thermal_stem = PatchEmbedGeneric(
-            [
-                nn.Conv2d(
-                    kernel_size=thermal_kernel_size,
-                    in_channels=1,
-                    out_channels=thermal_embed_dim,
-                    stride=thermal_kernel_size,
-                    bias=False,
-                ),
-            ],
-            norm_layer=nn.LayerNorm(normalized_shape=thermal_embed_dim),
-        )
-        thermal_preprocessor = ThermalPreprocessor(
-            img_size=[1, 224, 224],
-            num_cls_tokens=1,
-            pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
-            thermal_stem=thermal_stem,
-        )
-
-        imu_stem = PatchEmbedGeneric(
-            [
-                nn.Linear(
-                    in_features=48,
-                    out_features=imu_embed_dim,
-                    bias=False,
-                ),
-            ],
-            norm_layer=nn.LayerNorm(normalized_shape=imu_embed_dim),
-        )
+        modality_preprocessors = {}
+
+        if ModalityType.VISION in self.modalities:
+            rgbt_stem = PatchEmbedGeneric(
+                proj_stem=[
+                    PadIm2Video(pad_type="repeat", ntimes=2),
+                    nn.Conv3d(
+                        in_channels=3,
+                        kernel_size=kernel_size,
+                        out_channels=vision_embed_dim,
+                        stride=kernel_size,
+                        bias=False,
+                    ),
+                ]
+            )
+            rgbt_preprocessor = RGBDTPreprocessor(
+                img_size=[3, video_frames, 224, 224],
+                num_cls_tokens=1,
+                pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
+                rgbt_stem=rgbt_stem,
+                depth_stem=None,
+            )
+            modality_preprocessors[ModalityType.VISION] = rgbt_preprocessor
+
+        if ModalityType.TEXT in self.modalities:
+            text_preprocessor = TextPreprocessor(
+                context_length=77,
+                vocab_size=49408,
+                embed_dim=text_embed_dim,
+                causal_masking=True,
+                pack_sequences=self.pack_text,
+            )
+            modality_preprocessors[ModalityType.TEXT] = text_preprocessor
+
+        if ModalityType.AUDIO in self.modalities:
+            audio_stem = PatchEmbedGeneric(
+                proj_stem=[
+                    nn.Conv2d(
+                        in_channels=1,
+                        kernel_size=audio_kernel_size,
+                        stride=audio_stride,
+                        out_channels=audio_embed_dim,
+                        bias=False,
+                    ),
+                ],
+                norm_layer=nn.LayerNorm(normalized_shape=audio_embed_dim),
+            )
+            audio_preprocessor = AudioPreprocessor(
+                img_size=[1, audio_num_mel_bins, audio_target_len],
+                num_cls_tokens=1,
+                pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
+                audio_stem=audio_stem,
+            )
+            modality_preprocessors[ModalityType.AUDIO] = audio_preprocessor
+
+        if ModalityType.DEPTH in self.modalities:
+            depth_stem = PatchEmbedGeneric(
+                [
+                    nn.Conv2d(
+                        kernel_size=depth_kernel_size,
+                        in_channels=1,
+                        out_channels=depth_embed_dim,
+                        stride=depth_kernel_size,
+                        bias=False,
+                    ),
+                ],
+                norm_layer=nn.LayerNorm(normalized_shape=depth_embed_dim),
+            )
 
-        imu_preprocessor = IMUPreprocessor(
-            img_size=[6, 2000],
-            num_cls_tokens=1,
-            kernel_size=8,
-            embed_dim=imu_embed_dim,
-            pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
-            imu_stem=imu_stem,
-        )
+            depth_preprocessor = RGBDTPreprocessor(
+                img_size=[1, 224, 224],
+                num_cls_tokens=1,
+                pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
+                rgbt_stem=None,
+                depth_stem=depth_stem,
+            )
+            modality_preprocessors[ModalityType.DEPTH] = depth_preprocessor
+
+        if ModalityType.THERMAL in self.modalities:
+            thermal_stem = PatchEmbedGeneric(
+                [
+                    nn.Conv2d(
+                        kernel_size=thermal_kernel_size,
+                        in_channels=1,
+                        out_channels=thermal_embed_dim,
+                        stride=thermal_kernel_size,
+                        bias=False,
+                    ),
+                ],
+                norm_layer=nn.LayerNorm(normalized_shape=thermal_embed_dim),
+            )
+            thermal_preprocessor = ThermalPreprocessor(
+                img_size=[1, 224, 224],
+                num_cls_tokens=1,
+                pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
+                thermal_stem=thermal_stem,
+            )
+            modality_preprocessors[ModalityType.THERMAL] = thermal_preprocessor
+
+        if ModalityType.IMU in self.modalities:
+            imu_stem = PatchEmbedGeneric(
+                [
+                    nn.Linear(
+                        in_features=48,
+                        out_features=imu_embed_dim,
+                        bias=False,
+                    ),
+                ],
+                norm_layer=nn.LayerNorm(normalized_shape=imu_embed_dim),
+            )
 
-        modality_preprocessors = {
-            ModalityType.VISION: rgbt_preprocessor,
-            ModalityType.TEXT: text_preprocessor,
-            ModalityType.AUDIO: audio_preprocessor,
-            ModalityType.DEPTH: depth_preprocessor,
-            ModalityType.THERMAL: thermal_preprocessor,
-            ModalityType.IMU: imu_preprocessor,
-        }
+            imu_preprocessor = IMUPreprocessor(
+                img_size=[6, 2000],
+                num_cls_tokens=1,
+                kernel_size=8,
+                embed_dim=imu_embed_dim,
+                pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
+                imu_stem=imu_stem,
+            )
+            modality_preprocessors[ModalityType.IMU] = imu_preprocessor
 
         return nn.ModuleDict(modality_preprocessors)
 
@@ -299,78 +338,108 @@ class ImageBindModel(nn.Module):
         imu_drop_path=0.7,
     ):
         def instantiate_trunk(
-            embed_dim, num_blocks, num_heads, pre_transformer_ln, add_bias_kv, drop_path
+            embed_dim,
+            num_blocks,
+            num_heads,
+            pre_transformer_ln,
+            add_bias_kv,
+            drop_path,
+            causal=False,
         ):
-            return SimpleTransformer(
-                embed_dim=embed_dim,
-                num_blocks=num_blocks,
-                ffn_dropout_rate=0.0,
-                drop_path_rate=drop_path,
-                attn_target=partial(
+            norm = (
+                nn.LayerNorm(embed_dim, eps=1e-6)
+                if pre_transformer_ln
+                else nn.Identity()
+            )
+            if self.fused_attention:
+                attn_target = partial(
+                    FusedMultiheadAttention,
+                    embed_dim=embed_dim,
+                    num_heads=num_heads,
+                    bias=True,
+                    add_bias_kv=add_bias_kv,
+                    causal=causal,
+                )
+                pre_transformer_layer = nn.Sequential(norm)
+                post_transformer_layer = None
+            else:
+                attn_target = partial(
                     MultiheadAttention,
                     embed_dim=embed_dim,
                     num_heads=num_heads,
                     bias=True,
                     add_bias_kv=add_bias_kv,
-                ),
-                pre_transformer_layer=nn.Sequential(
-                    nn.LayerNorm(embed_dim, eps=1e-6)
-                    if pre_transformer_ln
-                    else nn.Identity(),
-                    EinOpsRearrange("b l d -> l b d"),
-                ),
-                post_transformer_layer=EinOpsRearrange("l b d -> b l d"),
+                )
+                pre_transformer_layer = nn.Sequential(
+                    norm, EinOpsRearrange("b l d -> l b d")
+                )
+                post_transformer_layer = EinOpsRearrange("l b d -> b l d")
+            return SimpleTransformer(
+                embed_dim=embed_dim,
+                num_blocks=num_blocks,
+                ffn_dropout_rate=0.0,
+                drop_path_rate=drop_path,
+                attn_target=attn_target,
+                pre_transformer_layer=pre_transformer_layer,
+                post_transformer_layer=post_transformer_layer,
             )
 
         modality_trunks = {}
-        modality_trunks[ModalityType.VISION] = instantiate_trunk(
-            vision_embed_dim,
-            vision_num_blocks,
-            vision_num_heads,
-            pre_transformer_ln=True,
-            add_bias_kv=False,
-            drop_path=0.0,
-        )
-        modality_trunks[ModalityType.TEXT] = instantiate_trunk(
-            text_embed_dim,
-            text_num_blocks,
-            text_num_heads,
-            pre_transformer_ln=False,
-            add_bias_kv=False,
-            drop_path=0.0,
-        )
-        modality_trunks[ModalityType.AUDIO] = instantiate_trunk(
-            audio_embed_dim,
-            audio_num_blocks,
-            audio_num_heads,
-            pre_transformer_ln=False,
-            add_bias_kv=True,
-            drop_path=audio_drop_path,
-        )
-        modality_trunks[ModalityType.DEPTH] = instantiate_trunk(
-            depth_embed_dim,
-            depth_num_blocks,
-            depth_num_heads,
-            pre_transformer_ln=False,
-            add_bias_kv=True,
-            drop_path=depth_drop_path,
-        )
-        modality_trunks[ModalityType.THERMAL] = instantiate_trunk(
-            thermal_embed_dim,
-            thermal_num_blocks,
-            thermal_num_heads,
-            pre_transformer_ln=False,
-            add_bias_kv=True,
-            drop_path=thermal_drop_path,
-        )
-        modality_trunks[ModalityType.IMU] = instantiate_trunk(
-            imu_embed_dim,
-            imu_num_blocks,
-            imu_num_heads,
-            pre_transformer_ln=False,
-            add_bias_kv=True,
-            drop_path=imu_drop_path,
-        )
+        if ModalityType.VISION in self.modalities:
+            modality_trunks[ModalityType.VISION] = instantiate_trunk(
+                vision_embed_dim,
+                vision_num_blocks,
+                vision_num_heads,
+                pre_transformer_ln=True,
+                add_bias_kv=False,
+                drop_path=0.0,
+            )
+        if ModalityType.TEXT in self.modalities:
+            modality_trunks[ModalityType.TEXT] = instantiate_trunk(
+                text_embed_dim,
+                text_num_blocks,
+                text_num_heads,
+                pre_transformer_ln=False,
+                add_bias_kv=False,
+                drop_path=0.0,
+                causal=True,
+            )
+        if ModalityType.AUDIO in self.modalities:
+            modality_trunks[ModalityType.AUDIO] = instantiate_trunk(
+                audio_embed_dim,
+                audio_num_blocks,
+                audio_num_heads,
+                pre_transformer_ln=False,
+                add_bias_kv=True,
+                drop_path=audio_drop_path,
+            )
+        if ModalityType.DEPTH in self.modalities:
+            modality_trunks[ModalityType.DEPTH] = instantiate_trunk(
+                depth_embed_dim,
+                depth_num_blocks,
+                depth_num_heads,
+                pre_transformer_ln=False,
+                add_bias_kv=True,
+                drop_path=depth_drop_path,
+            )
+        if ModalityType.THERMAL in self.modalities:
+            modality_trunks[ModalityType.THERMAL] = instantiate_trunk(
+                thermal_embed_dim,
+                thermal_num_blocks,
+                thermal_num_heads,
+                pre_transformer_ln=False,
+                add_bias_kv=True,
+                drop_path=thermal_drop_path,
+            )
+        if ModalityType.IMU in self.modalities:
+            modality_trunks[ModalityType.IMU] = instantiate_trunk(
+                imu_embed_dim,
+                imu_num_blocks,
+                imu_num_heads,
+                pre_transformer_ln=False,
+                add_bias_kv=True,
+                drop_path=imu_drop_path,
+            )
 
         return nn.ModuleDict(modality_trunks)
 
@@ -386,75 +455,92 @@ class ImageBindModel(nn.Module):
     ):
         modality_heads = {}
 
-        modality_heads[ModalityType.VISION] = nn.Sequential(
-            nn.LayerNorm(normalized_shape=vision_embed_dim, eps=1e-6),
-            SelectElement(index=0),
-            nn.Linear(vision_embed_dim, out_embed_dim, bias=False),
-        )
+        if ModalityType.VISION in self.modalities:
+            modality_heads[ModalityType.VISION] = nn.Sequential(
+                nn.LayerNorm(normalized_shape=vision_embed_dim, eps=1e-6),
+                SelectElement(index=0),
+                nn.Linear(vision_embed_dim, out_embed_dim, bias=False),
+            )
 
-        modality_heads[ModalityType.TEXT] = SelectEOSAndProject(
-            proj=nn.Sequential(
-                nn.LayerNorm(normalized_shape=text_embed_dim, eps=1e-6),
-                nn.Linear(text_embed_dim, out_embed_dim, bias=False),
+        if ModalityType.TEXT in self.modalities:
+            modality_heads[ModalityType.TEXT] = SelectEOSAndProject(
+                proj=nn.Sequential(
+                    nn.LayerNorm(normalized_shape=text_embed_dim, eps=1e-6),
+                    nn.Linear(text_embed_dim, out_embed_dim, bias=False),
+                )
             )
-        )
 
-        modality_heads[ModalityType.AUDIO] = nn.Sequential(
-            nn.LayerNorm(normalized_shape=audio_embed_dim, eps=1e-6),
-            SelectElement(index=0),
-            nn.Linear(audio_embed_dim, out_embed_dim, bias=False),
-        )
+        if ModalityType.AUDIO in self.modalities:
+            modality_heads[ModalityType.AUDIO] = nn.Sequential(
+                nn.LayerNorm(normalized_shape=audio_embed_dim, eps=1e-6),
+                SelectElement(index=0),
+                nn.Linear(audio_embed_dim, out_embed_dim, bias=False),
+            )
 
-        modality_heads[ModalityType.DEPTH] = nn.Sequential(
-            nn.LayerNorm(normalized_shape=depth_embed_dim, eps=1e-6),
-            SelectElement(index=0),
-            nn.Linear(depth_embed_dim, out_embed_dim, bias=False),
-        )
+        if ModalityType.DEPTH in self.modalities:
+            modality_heads[ModalityType.DEPTH] = nn.Sequential(
+                nn.LayerNorm(normalized_shape=depth_embed_dim, eps=1e-6),
+                SelectElement(index=0),
+                nn.Linear(depth_embed_dim, out_embed_dim, bias=False),
+            )
 
-        modality_heads[ModalityType.THERMAL] = nn.Sequential(
-            nn.LayerNorm(normalized_shape=thermal_embed_dim, eps=1e-6),
-            SelectElement(index=0),
-            nn.Linear(thermal_embed_dim, out_embed_dim, bias=False),
-        )
+        if ModalityType.THERMAL in self.modalities:
+            modality_heads[ModalityType.THERMAL] = nn.Sequential(
+                nn.LayerNorm(normalized_shape=thermal_embed_dim, eps=1e-6),
+                SelectElement(index=0),
+                nn.Linear(thermal_embed_dim, out_embed_dim, bias=False),
+            )
 
-        modality_heads[ModalityType.IMU] = nn.Sequential(
-            nn.LayerNorm(normalized_shape=imu_embed_dim, eps=1e-6),
-            SelectElement(index=0),
-            nn.Dropout(p=0.5),
-            nn.Linear(imu_embed_dim, out_embed_dim, bias=False),
-        )
+        if ModalityType.IMU in self.modalities:
+            modality_heads[ModalityType.IMU] = nn.Sequential(
+                nn.LayerNorm(normalized_shape=imu_embed_dim, eps=1e-6),
+                SelectElement(index=0),
+                nn.Dropout(p=0.5),
+                nn.Linear(imu_embed_dim, out_embed_dim, bias=False),
+            )
 
         return nn.ModuleDict(modality_heads)
 
     def _create_modality_postprocessors(self, out_embed_dim):
         modality_postprocessors = {}
 
-        modality_postprocessors[ModalityType.VISION] = Normalize(dim=-1)
-        modality_postprocessors[ModalityType.TEXT] = nn.Sequential(
-            Normalize(dim=-1), LearnableLogitScaling(learnable=True)
-        )
-        modality_postprocessors[ModalityType.AUDIO] = nn.Sequential(
-            Normalize(dim=-1),
-            LearnableLogitScaling(logit_scale_init=20.0, learnable=False),
-        )
-        modality_postprocessors[ModalityType.DEPTH] = nn.Sequential(
-            Normalize(dim=-1),
-            LearnableLogitScaling(logit_scale_init=5.0, learnable=False),
-        )
-        modality_postprocessors[ModalityType.THERMAL] = nn.Sequential(
-            Normalize(dim=-1),
-            LearnableLogitScaling(logit_scale_init=10.0, learnable=False),
-        )
-        modality_postprocessors[ModalityType.IMU] = nn.Sequential(
-            Normalize(dim=-1),
-            LearnableLogitScaling(logit_scale_init=5.0, learnable=False),
-        )
+        if ModalityType.VISION in self.modalities:
+            modality_postprocessors[ModalityType.VISION] = Normalize(dim=-1)
+        if ModalityType.TEXT in self.modalities:
+            modality_postprocessors[ModalityType.TEXT] = nn.Sequential(
+                Normalize(dim=-1), LearnableLogitScaling(learnable=True)
+            )
+        if ModalityType.AUDIO in self.modalities:
+            modality_postprocessors[ModalityType.AUDIO] = nn.Sequential(
+                Normalize(dim=-1),
+                LearnableLogitScaling(logit_scale_init=20.0, learnable=False),
+            )
+        if ModalityType.DEPTH in self.modalities:
+            modality_postprocessors[ModalityType.DEPTH] = nn.Sequential(
+                Normalize(dim=-1),
+                LearnableLogitScaling(logit_scale_init=5.0, learnable=False),
+            )
+        if ModalityType.THERMAL in self.modalities:
+            modality_postprocessors[ModalityType.THERMAL] = nn.Sequential(
+                Normalize(dim=-1),
+                LearnableLogitScaling(logit_scale_init=10.0, learnable=False),
+            )
+        if ModalityType.IMU in self.modalities:
+            modality_postprocessors[ModalityType.IMU] = nn.Sequential(
+                Normalize(dim=-1),
+                LearnableLogitScaling(logit_scale_init=5.0, learnable=False),
+            )
 
         return nn.ModuleDict(modality_postprocessors)
 
     def forward(self, inputs):
         outputs = {}
         for modality_key, modality_value in inputs.items():
+            if modality_key not in self.modalities:
+                raise ValueError(
+                    f"Modality {modality_key} was not built, this model only has "
+                    f"{self.modalities}"
+                )
             reduce_list = (
                 modality_value.ndim >= 5
             )  # Audio and Video inputs consist of multiple clips
@@ -470,6 +556,14 @@ class ImageBindModel(nn.Module):
                 )
                 trunk_inputs = modality_value["trunk"]
                 head_inputs = modality_value["head"]
+                pooled = (
+                    self._pool_tokens(modality_key, head_inputs)
+                    if self.pool_final_block
+                    else None
+                )
+                if pooled is not None:
+                    trunk_inputs = dict(trunk_inputs, pool_tokens=pooled[0])
+                    head_inputs = pooled[1]
                 modality_value = self.modality_trunks[modality_key](**trunk_inputs)
                 modality_value = self.modality_heads[modality_key](
                     modality_value, **head_inputs
@@ -486,32 +580,186 @@ class ImageBindModel(nn.Module):
 
         return outputs
 
+    def _pool_tokens(self, modality_key, head_inputs):
+        """
+        Returns the (rows, positions) of the tokens the head of a modality
+        reads, for SimpleTransformer.forward, and the head inputs that read
+        them from the N x 1 x D pooled output of the trunk, or None if the
+        head is not a single token selection
+        """
+        head = self.modality_heads[modality_key]
+        if isinstance(head, SelectEOSAndProject):
+            positions = head_inputs["seq_len"]
+            return (head_inputs.get("rows"), positions), {
+                "seq_len": torch.zeros_like(positions)
+            }
+        selects = [m for m in head if isinstance(m, SelectElement)]
+        if len(selects) == 1 and selects[0].index == 0:
+            return (None, 0), head_inputs
+        return None
+
+    def register_text_prefix(self, name, prefix):
+        """
+        Registers a prefix shared by many texts, e.g. the tokens of
+        "a photo of a" for prompts "a photo of a {label}", whose keys and values
+        in the text trunk are then computed once and reused by
+        embed_text_with_prefix
+
+        Inputs:
+            name: The key the prefix is referred to by
+            prefix: 1D token ids of the prefix, starting with the start of
+                text token
+        """
+        if ModalityType.TEXT not in self.modalities:
+            raise ValueError(
+                f"Modality {ModalityType.TEXT} was not built, this model only has "
+                f"{self.modalities}"
+            )
+        self._text_prefixes[name] = {
+            "tokens": prefix.reshape(1, -1),
+            "kv": None,
+            "version": None,
+        }
 
-def imagebind_huge(pretrained=False):
-    model = ImageBindModel(
-        vision_embed_dim=1280,
-        vision_num_blocks=32,
-        vision_num_heads=16,
-        text_embed_dim=1024,
-        text_num_blocks=24,
-        text_num_heads=16,
-        out_embed_dim=1024,
-        audio_drop_path=0.1,
-        imu_drop_path=0.7,
-    )
+    def _text_weights_version(self):
+        # bumped by any in-place update of the text weights, e.g. an optimizer step
+        modules = (
+            self.modality_preprocessors[ModalityType.TEXT],
+            self.modality_trunks[ModalityType.TEXT],
+        )
+        return tuple(p._version for m in modules for p in m.parameters())
+
+    @torch.no_grad()
+    def _text_prefix_kv(self, name):
+        prefix = self._text_prefixes[name]
+        pos_embed = self.modality_preprocessors[ModalityType.TEXT].pos_embed
+        version = self._text_weights_version()
+        kv = prefix["kv"]
+        # recomputed if the model was moved, cast or updated since
+        if (
+            kv is None
+            or kv[0][0].device != pos_embed.device
+            or kv[0][0].dtype != pos_embed.dtype
+            or prefix["version"] != version
+        ):
+            trunk_inputs = self.modality_preprocessors[
+                ModalityType.TEXT
+            ].forward_prefix(prefix["tokens"].to(pos_embed.device))
+            kv = self.modality_trunks[ModalityType.TEXT].compute_prefix(**trunk_inputs)
+            prefix["kv"] = kv
+            prefix["version"] = version
+        return kv
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # the cached prefix keys and values are of the previous weights
+        for prefix in self._text_prefixes.values():
+            prefix["kv"] = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def embed_text_with_prefix(self, name, text):
+        """
+        Embeds texts that all start with a registered prefix, running only
+        their remaining tokens through the text trunk
+
+        Inputs:
+            name: The name the prefix was registered under
+            text: B x L token ids following the prefix, each ending with the
+                end of text token and padded with zeros
+
+        Returns:
+            the B x D embeddings of the prefixed texts
+        """
+        prefix_kv = self._text_prefix_kv(name)
+        prefix_length = self._text_prefixes[name]["tokens"].shape[1]
+        modality_value = self.modality_preprocessors[ModalityType.TEXT].forward_suffix(
+            text, prefix_length
+        )
+        trunk_inputs = modality_value["trunk"]
+        head_inputs = modality_value["head"]
+        modality_value = self.modality_trunks[ModalityType.TEXT].forward_with_prefix(
+            prefix_kv=prefix_kv, **trunk_inputs
+        )
+        modality_value = self.modality_heads[ModalityType.TEXT](
+            modality_value, **head_inputs
+        )
+        return self.modality_postprocessors[ModalityType.TEXT](modality_value)
+
+
+def filter_state_dict(state_dict, modalities):
+    """Keep the entries of an ImageBindModel state dict that belong to the given modalities"""
+    modalities = set(modalities)
+    return {
+        key: value
+        for key, value in state_dict.items()
+        if key.split(".")[1] in modalities
+    }
+
+
+def imagebind_huge(
+    pretrained=False,
+    checkpoint_path=DEFAULT_CHECKPOINT_PATH,
+    modalities=None,
+    fast_load=False,
+    fused_attention=True,
+    pack_text=False,
+):
+    """
+    Builds the imagebind_huge model
+
+    checkpoint_path is either a .pth checkpoint or a directory of per-modality
+    safetensors shards written by checkpoint.convert_checkpoint, of which only
+    the shards of the built modalities are memory-mapped. A missing .pth
+    checkpoint is downloaded, a missing shard directory raises FileNotFoundError.
+
+    With fast_load and pretrained, the model is built on the meta device, which
+    skips the random initialization of its ~1.2B parameters, and the parameters
+    are then assigned straight from the checkpoint tensors instead of being
+    allocated and overwritten by load_state_dict.
+
+    fused_attention builds batch-first trunks on scaled_dot_product_attention,
+    which load the same checkpoint, instead of nn.MultiheadAttention ones.
+
+    pack_text packs several short texts into each row of the text trunk, see
+    TextPreprocessor.pack.
+    """
+    fast_load = fast_load and pretrained
+    with torch.device("meta") if fast_load else contextlib.nullcontext():
+        model = ImageBindModel(
+            vision_embed_dim=1280,
+            vision_num_blocks=32,
+            vision_num_heads=16,
+            text_embed_dim=1024,
+            text_num_blocks=24,
+            text_num_heads=16,
+            out_embed_dim=EMBED_DIM,
+            audio_drop_path=0.1,
+            imu_drop_path=0.7,
+            modalities=modalities,
+            fused_attention=fused_attention,
+            pack_text=pack_text,
+        )
 
     if pretrained:
-        if not os.path.exists(".checkpoints/imagebind_huge.pth"):
-            print(
-                "Downloading imagebind weights to .checkpoints/imagebind_huge.pth ..."
-            )
-            os.makedirs(".checkpoints", exist_ok=True)
+        if not os.path.exists(checkpoint_path):
+            if not checkpoint_path.endswith(".pth"):
+                # a shard directory can only come from convert_checkpoint
+                raise FileNotFoundError(
+                    f"No checkpoint or shard directory at {checkpoint_path}"
+                )
+            print(f"Downloading imagebind weights to {checkpoint_path} ...")
+            os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
             torch.hub.download_url_to_file(
-                "https://dl.fbaipublicfiles.com/imagebind/imagebind_huge.pth",
-                ".checkpoints/imagebind_huge.pth",
+                CHECKPOINT_URL,
+                checkpoint_path,
                 progress=True,
             )
 
-        model.load_state_dict(torch.load(".checkpoints/imagebind_huge.pth"))
+        if is_shard_dir(checkpoint_path):
+            state_dict = load_shards(checkpoint_path, model.modalities)
+        else:
+            state_dict = torch.load(checkpoint_path, map_location="cpu")
+            if modalities is not None:
+                state_dict = filter_state_dict(state_dict, model.modalities)
+        model.load_state_dict(state_dict, assign=fast_load)
 
     return model
@@ -6,20 +6,23 @@
 # LICENSE file in the root directory of this source tree.
 
 import gzip
+import hashlib
 import html
 import io
 import math
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from functools import lru_cache
 from typing import Callable, List, Optional
 
-import ftfy
-
 import numpy as np
 import regex as re
 import torch
 import torch.nn as nn
-from iopath.common.file_io import g_pathmgr
-from timm.models.layers import trunc_normal_
+from torch.nn.init import trunc_normal_
 
 from .helpers import cast_if_src_dtype, VerboseNNModule
 
@@ -43,23 +46,38 @@ def get_sinusoid_encoding_table(n_position, d_hid):
     return torch.FloatTensor(sinusoid_table).unsqueeze(0)
 
 
-def interpolate_pos_encoding_2d(target_spatial_size, pos_embed):
+def interpolate_pos_encoding_2d(
+    target_spatial_size, pos_embed, source_layout=None, target_layout=None
+):
+    """
+    Resizes the grid of a 1 x N x D pos embedding to target_spatial_size
+    tokens. The source and target (H, W) layouts default to square grids,
+    give them for non-square ones.
+    """
     N = pos_embed.shape[1]
-    if N == target_spatial_size:
+    if N == target_spatial_size and (
+        target_layout is None or tuple(target_layout) == tuple(source_layout)
+    ):
         return pos_embed
     dim = pos_embed.shape[-1]
+    if source_layout is None:
+        source_layout = (int(math.sqrt(N)), int(math.sqrt(N)))
     # nn.functional.interpolate doesn't work with bfloat16 so we cast to float32
     pos_embed, updated = cast_if_src_dtype(pos_embed, torch.bfloat16, torch.float32)
-    pos_embed = nn.functional.interpolate(
-        pos_embed.reshape(1, int(math.sqrt(N)), int(math.sqrt(N)), dim).permute(
-            0, 3, 1, 2
-        ),
-        scale_factor=math.sqrt(target_spatial_size / N),
-        mode="bicubic",
-    )
+    pos_embed = pos_embed.reshape(1, *source_layout, dim).permute(0, 3, 1, 2)
+    if target_layout is None:
+        pos_embed = nn.functional.interpolate(
+            pos_embed,
+            scale_factor=math.sqrt(target_spatial_size / N),
+            mode="bicubic",
+        )
+    else:
+        pos_embed = nn.functional.interpolate(
+            pos_embed, size=tuple(target_layout), mode="bicubic"
+        )
     if updated:
         pos_embed, _ = cast_if_src_dtype(pos_embed, torch.float32, torch.bfloat16)
-    pos_embed = pos_embed.permute(0, 2, 3, 1).view(1, -1, dim)
+    pos_embed = pos_embed.permute(0, 2, 3, 1).reshape(1, -1, dim)
     return pos_embed
 
 
@@ -69,22 +87,39 @@ def interpolate_pos_encoding(
     patches_layout,
     input_shape=None,
     first_patch_idx=1,
+    target_layout=None,
 ):
+    """
+    Resizes a pos embedding trained for patches_layout to npatch_per_img
+    patches. target_layout is the layout of those patches, e.g. from
+    PatchEmbedGeneric.get_input_layout, and is required for non-square ones.
+    """
     assert first_patch_idx == 0 or first_patch_idx == 1, "there is 1 CLS token or none"
     N = pos_embed.shape[1] - first_patch_idx  # since it's 1 if cls_token exists
-    if npatch_per_img == N:
+    if npatch_per_img == N and (
+        target_layout is None or tuple(target_layout[-2:]) == tuple(patches_layout[-2:])
+    ):
         return pos_embed
 
-    assert (
-        patches_layout[-1] == patches_layout[-2]
-    ), "Interpolation of pos embed not supported for non-square layouts"
+    if target_layout is None:
+        assert (
+            patches_layout[-1] == patches_layout[-2]
+        ), "Interpolation of pos embed not supported for non-square layouts"
+        spatial_layouts = {}
+    else:
+        spatial_layouts = {
+            "source_layout": patches_layout[-2:],
+            "target_layout": target_layout[-2:],
+        }
 
     class_emb = pos_embed[:, :first_patch_idx]
     pos_embed = pos_embed[:, first_patch_idx:]
 
-    if input_shape is None or patches_layout[0] == 1:
+    if input_shape is None or len(patches_layout) == 2 or patches_layout[0] == 1:
         # simple 2D pos embedding, no temporal component
-        pos_embed = interpolate_pos_encoding_2d(npatch_per_img, pos_embed)
+        pos_embed = interpolate_pos_encoding_2d(
+            npatch_per_img, pos_embed, **spatial_layouts
+        )
     elif patches_layout[0] > 1:
         # pos embed has a temporal component
         assert len(input_shape) == 4, "temporal interpolation not supported"
@@ -94,7 +129,7 @@ def interpolate_pos_encoding(
         pos_embed = pos_embed.view(1, num_frames, num_spatial_tokens, -1)
         # interpolate embedding for zeroth frame
         pos_embed = interpolate_pos_encoding_2d(
-            npatch_per_img, pos_embed[0, 0, ...].unsqueeze(0)
+            npatch_per_img, pos_embed[0, 0, ...].unsqueeze(0), **spatial_layouts
         )
     else:
         raise ValueError("This type of interpolation isn't implemented")
@@ -108,6 +143,7 @@ def _get_pos_embedding(
     patches_layout,
     input_shape,
     first_patch_idx=1,
+    target_layout=None,
 ):
     pos_embed = interpolate_pos_encoding(
         npatch_per_img,
@@ -115,6 +151,7 @@ def _get_pos_embedding(
         patches_layout,
         input_shape=input_shape,
         first_patch_idx=first_patch_idx,
+        target_layout=target_layout,
     )
     return pos_embed
 
@@ -134,6 +171,74 @@ class PatchEmbedGeneric(nn.Module):
             # trained with a standard stem
             self.proj = proj_stem[0]
         self.norm_layer = norm_layer
+        self.image_fold = self.get_image_fold(proj_stem)
+
+    @staticmethod
+    def get_image_fold(proj_stem):
+        """
+        Returns the pad type of a PadIm2Video + Conv3d stem whose kernel spans
+        exactly the padded frames, None for any other stem. Such a stem sees a
+        single output frame per image, which a Conv2d with the temporal slices
+        of the kernel folded together computes without padding the image.
+        """
+        if len(proj_stem) != 2:
+            return None
+        pad, conv = proj_stem
+        if not (
+            isinstance(pad, PadIm2Video)
+            and pad.time_dim == 2
+            and isinstance(conv, nn.Conv3d)
+            and conv.padding_mode == "zeros"
+            and not isinstance(conv.padding, str)
+        ):
+            return None
+        if conv.kernel_size[0] != pad.ntimes or conv.padding[0] != 0:
+            return None
+        return pad.pad_type
+
+    def fold_images(self, x):
+        """
+        Applies the stem to B x C x H x W images with the folded Conv2d,
+        returning B x D x H' x W' like the B x D x 1 x H' x W' of the stem
+        """
+        conv = self.proj[1]
+        if self.image_fold == "repeat":
+            # the padded frames are copies, so their kernel slices add up
+            weight = conv.weight.sum(2)
+        else:
+            # the padded frames are zeros, only the first slice sees the image
+            weight = conv.weight[:, :, 0]
+        return nn.functional.conv2d(
+            x,
+            weight,
+            conv.bias,
+            conv.stride[1:],
+            conv.padding[1:],
+            conv.dilation[1:],
+            conv.groups,
+        )
+
+    def get_input_layout(self, input_shape):
+        """
+        Returns the patch layout of an input of the given shape, as
+        get_patch_layout would, from the arithmetic of the stem convolution
+        instead of a forward pass
+        """
+        conv = self.proj[-1] if isinstance(self.proj, nn.Sequential) else self.proj
+        if not isinstance(conv, (nn.Conv2d, nn.Conv3d)) or isinstance(
+            conv.padding, str
+        ):
+            return None
+        sizes = list(input_shape[2:])
+        if len(sizes) < len(conv.kernel_size):
+            # an image into a video stem, padded to ntimes frames
+            sizes = [self.proj[0].ntimes] + sizes
+        return tuple(
+            (size + 2 * padding - dilation * (kernel - 1) - 1) // stride + 1
+            for size, kernel, stride, padding, dilation in zip(
+                sizes, conv.kernel_size, conv.stride, conv.padding, conv.dilation
+            )
+        )
 
     def get_patch_layout(self, img_size):
         with torch.no_grad():
@@ -150,7 +255,10 @@ class PatchEmbedGeneric(nn.Module):
         return patches_layout, num_patches, embed_dim
 
     def forward(self, x):
-        x = self.proj(x)
+        if x.ndim == 4 and self.image_fold is not None:
+            x = self.fold_images(x)
+        else:
+            x = self.proj(x)
         # B C (T) H W -> B (T)HW C
         x = x.flatten(2).transpose(1, 2)
         if self.norm_layer is not None:
@@ -158,6 +266,10 @@ class PatchEmbedGeneric(nn.Module):
         return x
 
 
+# the number of interpolated pos embeddings kept per helper
+POS_EMBED_CACHE_SIZE = 8
+
+
 class SpatioTemporalPosEmbeddingHelper(VerboseNNModule):
     def __init__(
         self,
@@ -180,18 +292,57 @@ class SpatioTemporalPosEmbeddingHelper(VerboseNNModule):
             self.register_buffer(
                 "pos_embed", get_sinusoid_encoding_table(self.num_tokens, embed_dim)
             )
-
-    def get_pos_embedding(self, vision_input, all_vision_tokens):
+        # interpolated pos embeddings of other layouts, least recently used first
+        self._pos_embed_cache = OrderedDict()
+
+    def get_pos_embedding(self, vision_input, all_vision_tokens, patches_layout=None):
+        """
+        Returns the pos embedding of the tokens of an input, interpolated if
+        its patch layout, given by patches_layout, is not the trained one.
+        Interpolations are cached per layout, dtype and device unless they
+        need gradients.
+        """
         input_shape = vision_input.shape
+        npatch_per_img = all_vision_tokens.size(1) - self.num_cls_tokens
+        if npatch_per_img == self.num_patches and (
+            patches_layout is None
+            or tuple(patches_layout[-2:]) == tuple(self.patches_layout[-2:])
+        ):
+            return self.pos_embed
+
+        cacheable = not (torch.is_grad_enabled() and self.pos_embed.requires_grad)
+        key = (
+            npatch_per_img,
+            None if patches_layout is None else tuple(patches_layout),
+            len(input_shape),
+            self.pos_embed.dtype,
+            self.pos_embed.device,
+            # bumped by any in-place update of the weights
+            self.pos_embed._version,
+        )
+        if cacheable and key in self._pos_embed_cache:
+            self._pos_embed_cache.move_to_end(key)
+            return self._pos_embed_cache[key]
+
         pos_embed = _get_pos_embedding(
-            all_vision_tokens.size(1) - self.num_cls_tokens,
+            npatch_per_img,
             pos_embed=self.pos_embed,
             patches_layout=self.patches_layout,
             input_shape=input_shape,
             first_patch_idx=self.num_cls_tokens,
+            target_layout=patches_layout,
         )
+        if cacheable:
+            self._pos_embed_cache[key] = pos_embed
+            if len(self._pos_embed_cache) > POS_EMBED_CACHE_SIZE:
+                self._pos_embed_cache.popitem(last=False)
         return pos_embed
 
+    def _load_from_state_dict(self, *args, **kwargs):
+        # the cached interpolations are of the previous weights
+        self._pos_embed_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
+
 
 class RGBDTPreprocessor(VerboseNNModule):
     def __init__(
@@ -265,7 +416,9 @@ class RGBDTPreprocessor(VerboseNNModule):
             )  # stole class_tokens impl from Phil Wang, thanks
             tokens = torch.cat((class_tokens, tokens), dim=1)
         if self.use_pos_embed:
-            pos_embed = self.pos_embedding_helper.get_pos_embedding(input, tokens)
+            pos_embed = self.pos_embedding_helper.get_pos_embedding(
+                input, tokens, stem.get_input_layout(input.shape)
+            )
             tokens = tokens + pos_embed
         if self.use_type_embed:
             tokens = tokens + self.type_embed.expand(B, -1, -1)
@@ -334,9 +487,13 @@ class TextPreprocessor(VerboseNNModule):
         supply_seq_len_to_head: bool = True,
         num_cls_tokens: int = 0,
         init_param_style: str = "openclip",
+        trim_padding: bool = True,
+        pack_sequences: bool = False,
     ) -> None:
         super().__init__()
         self.vocab_size = vocab_size
+        self.trim_padding = trim_padding
+        self.pack_sequences = pack_sequences
         self.context_length = context_length
         self.token_embedding = nn.Embedding(vocab_size, embed_dim)
         self.pos_embed = nn.Parameter(
@@ -376,7 +533,113 @@ class TextPreprocessor(VerboseNNModule):
         else:
             raise ValueError(f"Unknown init {init_param_style}")
 
+    def pack(self, text):
+        """
+        Packs the sequences of a batch into as few rows of context_length
+        tokens as possible, longest first, each into the first row it fits in
+
+        Returns:
+            the packed token ids and the position of each token within its own
+            sequence, both R x L, an R x L x L mask that is causal within each
+            sequence and blocks attention across them, and the row and EOS
+            position of each input sequence
+        """
+        lengths = (text.argmax(dim=-1) + 1).tolist()
+        order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+        fill = []
+        rows = [0] * len(lengths)
+        starts = [0] * len(lengths)
+        for i in order:
+            for row, used in enumerate(fill):
+                if used + lengths[i] <= self.context_length:
+                    break
+            else:
+                row = len(fill)
+                fill.append(0)
+            rows[i] = row
+            starts[i] = fill[row]
+            fill[row] += lengths[i]
+
+        shape = (len(fill), max(fill))
+        packed = text.new_zeros(shape)
+        positions = torch.zeros(shape, dtype=torch.long, device=text.device)
+        # the padding at the end of each row forms a sequence of its own so that
+        # every token attends to something
+        segments = torch.full(shape, -1, dtype=torch.long, device=text.device)
+        for i, (row, start, length) in enumerate(zip(rows, starts, lengths)):
+            packed[row, start : start + length] = text[i, :length]
+            positions[row, start : start + length] = torch.arange(length)
+            segments[row, start : start + length] = i
+
+        allowed = segments[:, :, None] == segments[:, None, :]
+        allowed &= torch.ones(
+            shape[1], shape[1], dtype=torch.bool, device=text.device
+        ).tril()
+        mask = torch.zeros(
+            (*shape, shape[1]), dtype=self.pos_embed.dtype, device=text.device
+        )
+        mask.masked_fill_(~allowed, float("-inf"))
+
+        rows = torch.tensor(rows, device=text.device)
+        eos = torch.tensor(starts, device=text.device) + rows.new_tensor(lengths) - 1
+        return packed, positions, mask, rows, eos
+
+    def forward_prefix(self, prefix):
+        """
+        Returns the trunk inputs of a 1 x P prefix of token ids, starting with
+        the start of text token, for SimpleTransformer.compute_prefix
+        """
+        assert self.causal_masking and self.num_cls_tokens == 0
+        length = prefix.shape[1]
+        return {
+            "tokens": self.token_embedding(prefix) + self.pos_embed[:, :length],
+            "attn_mask": self.mask[:length, :length],
+        }
+
+    def forward_suffix(self, text, prefix_length):
+        """
+        Returns the trunk and head inputs of B x L token ids that follow a
+        prefix of prefix_length tokens, for SimpleTransformer.forward_with_prefix.
+        Each suffix ends with the end of text token, followed by padding.
+        """
+        assert self.causal_masking and self.num_cls_tokens == 0
+        if self.trim_padding and text.shape[0] > 0:
+            text = text[:, : int(text.argmax(dim=-1).max()) + 1]
+        length = text.shape[1]
+        end = prefix_length + length
+        text_tokens = self.token_embedding(text) + self.pos_embed[:, prefix_length:end]
+        return {
+            "trunk": {
+                "tokens": text_tokens,
+                "attn_mask": self.mask[prefix_length:end, :end],
+            },
+            "head": {"seq_len": text.argmax(dim=-1)},
+        }
+
     def forward(self, text):
+        if (
+            self.pack_sequences
+            and self.causal_masking
+            and self.supply_seq_len_to_head
+            and self.num_cls_tokens == 0
+            and text.shape[0] > 0
+        ):
+            packed, positions, mask, rows, eos = self.pack(text)
+            text_tokens = self.token_embedding(packed) + self.pos_embed[0, positions]
+            return {
+                "trunk": {"tokens": text_tokens, "attn_mask": mask},
+                "head": {"seq_len": eos, "rows": rows},
+            }
+        if (
+            self.trim_padding
+            and self.causal_masking
+            and self.supply_seq_len_to_head
+            and text.shape[0] > 0
+        ):
+            # Attention is causal and the head reads the EOS token, so the
+            # padding after the longest sequence of the batch can't change the
+            # output and is cut along with the matching pos_embed and mask
+            text = text[:, : int(text.argmax(dim=-1).max()) + 1]
         # text tokens are of shape B x L x D
         text_tokens = self.token_embedding(text)
         # concat CLS tokens if any
@@ -386,7 +649,7 @@ class TextPreprocessor(VerboseNNModule):
                 B, -1, -1
             )  # stole class_tokens impl from Phil Wang, thanks
             text_tokens = torch.cat((class_tokens, text_tokens), dim=1)
-        text_tokens = text_tokens + self.pos_embed
+        text_tokens = text_tokens + self.pos_embed[:, : text_tokens.shape[1]]
         return_dict = {
             "trunk": {
                 "tokens": text_tokens,
@@ -400,7 +663,8 @@ class TextPreprocessor(VerboseNNModule):
                 "seq_len": text_lengths,
             }
         if self.causal_masking:
-            return_dict["trunk"].update({"attn_mask": self.mask})
+            seq_len = text.shape[1]
+            return_dict["trunk"].update({"attn_mask": self.mask[:seq_len, :seq_len]})
         return return_dict
 
 
@@ -484,6 +748,8 @@ def get_pairs(word):
 
 
 def basic_clean(text):
+    import ftfy
+
     text = ftfy.fix_text(text)
     text = html.unescape(html.unescape(text))
     return text.strip()
@@ -495,28 +761,207 @@ def whitespace_clean(text):
     return text
 
 
+# Bump when the layout of the compiled vocab artifact changes
+BPE_ARTIFACT_VERSION = 1
+
+# Where the compiled vocab artifact goes when the directory of the merges file
+# is read-only, e.g. a root-owned site-packages
+BPE_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "pegasus",
+)
+
+
+def parse_bpe(bpe_path):
+    """
+    Parses a gzipped merges file into the encoder and the bpe ranks
+    """
+    from iopath.common.file_io import g_pathmgr
+
+    with g_pathmgr.open(bpe_path, "rb") as fh:
+        bpe_bytes = io.BytesIO(fh.read())
+        merges = gzip.open(bpe_bytes).read().decode("utf-8").split("\n")
+    merges = merges[1 : 49152 - 256 - 2 + 1]
+    merges = [tuple(merge.split()) for merge in merges]
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v + "</w>" for v in vocab]
+    for merge in merges:
+        vocab.append("".join(merge))
+    vocab.extend(["<|startoftext|>", "<|endoftext|>"])
+    encoder = dict(zip(vocab, range(len(vocab))))
+    bpe_ranks = dict(zip(merges, range(len(merges))))
+    return encoder, bpe_ranks
+
+
+def bpe_artifact_paths(bpe_path):
+    """
+    Returns the paths the compiled artifact of a merges file is looked up at:
+    next to it, then in BPE_CACHE_DIR under a name unique to its location
+    """
+    bpe_path = os.path.abspath(bpe_path)
+    name = os.path.splitext(os.path.basename(bpe_path))[0]
+    digest = hashlib.sha1(bpe_path.encode("utf-8")).hexdigest()[:16]
+    return [
+        os.path.splitext(bpe_path)[0] + ".pkl",
+        os.path.join(BPE_CACHE_DIR, f"{name}-{digest}.pkl"),
+    ]
+
+
+def load_bpe(bpe_path):
+    """
+    Loads the encoder and the bpe ranks of a merges file
+
+    For a local file they are read from a compiled artifact, <name>.txt.pkl,
+    which is built from the merges file the first time and rebuilt whenever the
+    merges file or the artifact version changes. The artifact is written next
+    to the merges file, or to BPE_CACHE_DIR if that directory is read-only. If
+    it can be written to neither the merges file is parsed every time.
+    """
+    if not os.path.isfile(bpe_path):
+        return parse_bpe(bpe_path)
+
+    stat = os.stat(bpe_path)
+    source = (BPE_ARTIFACT_VERSION, stat.st_size, stat.st_mtime_ns)
+    artifact_paths = bpe_artifact_paths(bpe_path)
+    for artifact_path in artifact_paths:
+        try:
+            with open(artifact_path, "rb") as f:
+                artifact = pickle.load(f)
+            if artifact["source"] == source:
+                return artifact["encoder"], artifact["bpe_ranks"]
+        except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError):
+            pass
+
+    encoder, bpe_ranks = parse_bpe(bpe_path)
+    artifact = {"source": source, "encoder": encoder, "bpe_ranks": bpe_ranks}
+    for artifact_path in artifact_paths:
+        try:
+            os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+            # written to a temporary file first so readers never see a partial one
+            tmp_path = f"{artifact_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, artifact_path)
+            break
+        except OSError:
+            pass
+    return encoder, bpe_ranks
+
+
+# Text basic_clean leaves unchanged up to surrounding whitespace: printable
+# ASCII, tabs and newlines, without the "&" html entities start with
+PLAIN_TEXT = re.compile(r"[\t\n\r\x20-\x25\x27-\x7e]*")
+
+
+def build_merge_tables(encoder, bpe_ranks):
+    """
+    Encodes the bpe ranks as arrays for the merge kernel
+
+    Returns:
+        The pairs of symbol ids as sorted keys first * len(encoder) + second,
+        the rank of each pair and the id of the symbol it merges into.
+    """
+    n_vocab = len(encoder)
+    pairs = list(bpe_ranks.items())
+    keys = np.array(
+        [encoder[first] * n_vocab + encoder[second] for (first, second), _ in pairs],
+        dtype=np.int64,
+    )
+    ranks = np.array([rank for _, rank in pairs], dtype=np.int64)
+    merged = np.array([encoder[first + second] for (first, second), _ in pairs])
+    order = np.argsort(keys)
+    return keys[order], ranks[order], merged[order].astype(np.int64)
+
+
+def bpe_merge_ids(ids, pair_keys, pair_ranks, pair_merged, n_vocab):
+    """
+    Applies the bpe merges to a word given as symbol ids, with the same
+    semantics as SimpleTokenizer.bpe: the lowest ranked pair is merged
+    everywhere, left to right, until no pair of the word has a rank
+    """
+    word = ids.copy()
+    n = len(word)
+    while n > 1:
+        best_rank = -1
+        best = -1
+        for i in range(n - 1):
+            key = word[i] * n_vocab + word[i + 1]
+            j = np.searchsorted(pair_keys, key)
+            if j < len(pair_keys) and pair_keys[j] == key:
+                if best_rank < 0 or pair_ranks[j] < best_rank:
+                    best_rank = pair_ranks[j]
+                    best = j
+        if best < 0:
+            break
+        first = pair_keys[best] // n_vocab
+        second = pair_keys[best] % n_vocab
+        out = 0
+        i = 0
+        while i < n:
+            if i < n - 1 and word[i] == first and word[i + 1] == second:
+                word[out] = pair_merged[best]
+                i += 2
+            else:
+                word[out] = word[i]
+                i += 1
+            out += 1
+        n = out
+    return word[:n]
+
+
+@lru_cache()
+def get_bpe_kernel():
+    """Return bpe_merge_ids compiled with numba, cached on disk across runs"""
+    import numba
+
+    return numba.njit(cache=True)(bpe_merge_ids)
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenizer_worker(bpe_path, context_length, cache_size, use_numba):
+    global _worker_tokenizer
+    _worker_tokenizer = SimpleTokenizer(bpe_path, context_length, cache_size, use_numba)
+
+
+def _encode_in_worker(texts):
+    return [_worker_tokenizer.encode(text) for text in texts]
+
+
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str, context_length=77):
+    """
+    Args:
+        bpe_path (str): The gzipped merges file
+        context_length (int): The default number of tokens per text
+        cache_size (int): The maximum number of words whose merges are cached,
+            least recently used first out, None for no limit
+        use_numba (bool): Whether uncached words are merged by the numba
+            kernel instead of in Python. Off by default: importing numba and
+            loading the compiled kernel takes about a second per process, which
+            only pays off for large batches of mostly uncached words
+    """
+
+    def __init__(
+        self, bpe_path: str, context_length=77, cache_size=65536, use_numba=False
+    ):
+        self.bpe_path = bpe_path
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
 
-        with g_pathmgr.open(bpe_path, "rb") as fh:
-            bpe_bytes = io.BytesIO(fh.read())
-            merges = gzip.open(bpe_bytes).read().decode("utf-8").split("\n")
-        merges = merges[1 : 49152 - 256 - 2 + 1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v + "</w>" for v in vocab]
-        for merge in merges:
-            vocab.append("".join(merge))
-        vocab.extend(["<|startoftext|>", "<|endoftext|>"])
-        self.encoder = dict(zip(vocab, range(len(vocab))))
+        self.encoder, self.bpe_ranks = load_bpe(bpe_path)
         self.decoder = {v: k for k, v in self.encoder.items()}
-        self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {
+        self.special_tokens = {
             "<|startoftext|>": "<|startoftext|>",
             "<|endoftext|>": "<|endoftext|>",
         }
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        self.use_numba = use_numba
+        self._merge_tables = None
+        self._pool = None
+        self._pool_workers = None
         self.pat = re.compile(
             r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
             re.IGNORECASE,
@@ -524,8 +969,23 @@ class SimpleTokenizer(object):
         self.context_length = context_length
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
+        if token in self.special_tokens:
+            return self.special_tokens[token]
+        with self._cache_lock:
+            if token in self.cache:
+                self.cache.move_to_end(token)
+                return self.cache[token]
+        if self.use_numba:
+            word = self._bpe_numba(token)
+        else:
+            word = self._bpe_python(token)
+        with self._cache_lock:
+            self.cache[token] = word
+            if self.cache_size is not None and len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return word
+
+    def _bpe_python(self, token):
         word = tuple(token[:-1]) + (token[-1] + "</w>",)
         pairs = get_pairs(word)
 
@@ -560,14 +1020,24 @@ class SimpleTokenizer(object):
                 break
             else:
                 pairs = get_pairs(word)
-        word = " ".join(word)
-        self.cache[token] = word
-        return word
+        return " ".join(word)
+
+    def _bpe_numba(self, token):
+        if self._merge_tables is None:
+            self._merge_tables = build_merge_tables(self.encoder, self.bpe_ranks)
+        ids = [self.encoder[char] for char in token[:-1]]
+        ids.append(self.encoder[token[-1] + "</w>"])
+        ids = get_bpe_kernel()(
+            np.array(ids, dtype=np.int64), *self._merge_tables, len(self.encoder)
+        )
+        return " ".join([self.decoder[i] for i in ids.tolist()])
 
     def encode(self, text):
         bpe_tokens = []
-        text = whitespace_clean(basic_clean(text)).lower()
-        for token in re.findall(self.pat, text):
+        if PLAIN_TEXT.fullmatch(text) is None:
+            text = basic_clean(text)
+        text = whitespace_clean(text).lower()
+        for token in self.pat.findall(text):
             token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
             bpe_tokens.extend(
                 self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" ")
@@ -590,19 +1060,80 @@ class SimpleTokenizer(object):
         if isinstance(texts, str):
             texts = [texts]
 
+        result = self.tokenize_batch(texts, context_length)
+        if len(result) == 1:
+            return result[0]
+        return result
+
+    def tokenize_batch(
+        self, texts, context_length=None, num_workers=1, chunk_size=1024
+    ):
+        """
+        Tokenizes a list of texts
+
+        Args:
+            texts (List[str]): The texts to tokenize
+            context_length (int): The number of tokens per text, longer texts
+                are truncated, defaults to the tokenizer's context_length
+            num_workers (int): With more than one, batches larger than
+                chunk_size are split in chunks of chunk_size texts encoded
+                by a pool of that many processes, kept for later calls
+            chunk_size (int): The number of texts per chunk sent to a worker
+        Returns:
+            A (len(texts), context_length) LongTensor, even for a single text.
+        """
+        if not context_length:
+            context_length = self.context_length
+
+        if num_workers > 1 and len(texts) > chunk_size:
+            chunks = [
+                texts[i : i + chunk_size] for i in range(0, len(texts), chunk_size)
+            ]
+            pool = self._get_pool(num_workers)
+            encoded = [
+                ids for chunk in pool.map(_encode_in_worker, chunks) for ids in chunk
+            ]
+        else:
+            encoded = [self.encode(text) for text in texts]
+
         sot_token = self.encoder["<|startoftext|>"]
         eot_token = self.encoder["<|endoftext|>"]
-        all_tokens = [[sot_token] + self.encode(text) + [eot_token] for text in texts]
-        result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+        result = torch.zeros(len(encoded), context_length, dtype=torch.long)
 
-        for i, tokens in enumerate(all_tokens):
-            tokens = tokens[:context_length]
+        for i, ids in enumerate(encoded):
+            tokens = ([sot_token] + ids + [eot_token])[:context_length]
             result[i, : len(tokens)] = torch.tensor(tokens)
 
-        if len(result) == 1:
-            return result[0]
         return result
 
+    def _get_pool(self, num_workers):
+        """
+        Returns the pool of tokenizer processes, started on first use
+        """
+        if self._pool is None or self._pool_workers != num_workers:
+            self.close()
+            self._pool = ProcessPoolExecutor(
+                max_workers=num_workers,
+                initializer=_init_tokenizer_worker,
+                initargs=(
+                    self.bpe_path,
+                    self.context_length,
+                    self.cache_size,
+                    self.use_numba,
+                ),
+            )
+            self._pool_workers = num_workers
+        return self._pool
+
+    def close(self):
+        """
+        Shuts down the pool of tokenizer processes, if any
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+            self._pool_workers = None
+
 
 class IMUPreprocessor(VerboseNNModule):
     def __init__(
@@ -16,9 +16,12 @@ from typing import Callable, List
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 
-from timm.models.layers import DropPath, trunc_normal_
+from torch.nn.init import trunc_normal_
+
+from .helpers import DropPath
 
 
 class Attention(nn.Module):
@@ -92,10 +95,270 @@ class Mlp(nn.Module):
         return x
 
 
+def pool_index(pool_tokens, batch_size, device):
+    """
+    Returns the (rows, positions) of pool_tokens with rows filled in when it
+    is None, one token per sequence
+    """
+    rows, positions = pool_tokens
+    if rows is None:
+        rows = (
+            torch.arange(batch_size, device=device)
+            if torch.is_tensor(positions)
+            else slice(None)
+        )
+    return rows, positions
+
+
 class MultiheadAttention(nn.MultiheadAttention):
     def forward(self, x: torch.Tensor, attn_mask: torch.Tensor):
+        if attn_mask is not None and attn_mask.ndim == 3:
+            # one mask per sequence, e.g. for packed texts, repeated per head
+            attn_mask = attn_mask.repeat_interleave(self.num_heads, dim=0)
         return super().forward(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
 
+    def project_kv(self, x: torch.Tensor):
+        """
+        Returns the keys and values of x, of shape L x B x D, before the
+        split into heads
+        """
+        _, w_k, w_v = self.in_proj_weight.chunk(3)
+        _, b_k, b_v = (
+            self.in_proj_bias.chunk(3) if self.in_proj_bias is not None else (None,) * 3
+        )
+        return F.linear(x, w_k, b_k), F.linear(x, w_v, b_v)
+
+    def forward_with_past(
+        self, x: torch.Tensor, past_kv: tuple, attn_mask: torch.Tensor
+    ):
+        """
+        Attends the queries of x, of shape L x B x D, over past keys and values
+        from project_kv followed by those of x itself
+
+        past_kv holds tensors of shape P x 1 x D shared by the whole batch, or
+        P x B x D, and attn_mask is an additive mask of shape L x (P + L).
+        """
+        L, B, D = x.shape
+        q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        past_k, past_v = past_kv
+        k = torch.cat([past_k.expand(-1, B, -1), k])
+        v = torch.cat([past_v.expand(-1, B, -1), v])
+        if self.bias_k is not None:
+            k = torch.cat([k, self.bias_k.expand(-1, B, -1)])
+            v = torch.cat([v, self.bias_v.expand(-1, B, -1)])
+            if attn_mask is not None:
+                attn_mask = F.pad(attn_mask, (0, 1))
+
+        def split_heads(t):
+            return t.reshape(t.shape[0], B * self.num_heads, self.head_dim).transpose(
+                0, 1
+            )
+
+        q, k, v = split_heads(q), split_heads(k), split_heads(v)
+        q = q * self.head_dim**-0.5
+        attn = torch.bmm(q, k.transpose(-2, -1))
+        if attn_mask is not None:
+            attn = attn + attn_mask
+        out = torch.bmm(attn.softmax(dim=-1), v)
+        out = out.transpose(0, 1).reshape(L, B, D)
+        return self.out_proj(out)
+
+    def forward_pooled(self, x: torch.Tensor, attn_mask: torch.Tensor, pool_tokens):
+        """
+        Attends only the queries of the pooled tokens of x, of shape L x B x D,
+        over the keys and values of all the tokens of their sequence
+
+        pool_tokens holds the (rows, positions) of the N pooled tokens, where
+        positions is an index or N indices and rows is None for one token per
+        sequence. attn_mask is an additive L x L mask, or B x L x L with one
+        mask per sequence. Returns the 1 x N x D outputs of the pooled tokens.
+        """
+        L, B, D = x.shape
+        rows, positions = pool_index(pool_tokens, B, x.device)
+        w_q, w_kv = self.in_proj_weight.split([D, 2 * D])
+        b_q, b_kv = (
+            self.in_proj_bias.split([D, 2 * D])
+            if self.in_proj_bias is not None
+            else (None, None)
+        )
+        q = F.linear(x[positions, rows], w_q, b_q)
+        k, v = F.linear(x, w_kv, b_kv).chunk(2, dim=-1)
+        if self.bias_k is not None:
+            k = torch.cat([k, self.bias_k.expand(-1, B, -1)])
+            v = torch.cat([v, self.bias_v.expand(-1, B, -1)])
+        if attn_mask is not None:
+            if attn_mask.ndim == 2:
+                attn_mask = attn_mask[positions]
+            else:
+                attn_mask = attn_mask[rows, positions]
+            if self.bias_k is not None:
+                attn_mask = F.pad(attn_mask, (0, 1))
+            attn_mask = attn_mask.reshape(-1, 1, 1, k.shape[0])
+
+        def split_heads(t):
+            # L x B x D -> B x heads x L x head_dim, of the rows of the pooled tokens
+            return t.reshape(t.shape[0], B, self.num_heads, self.head_dim).permute(
+                1, 2, 0, 3
+            )[rows]
+
+        q = q.reshape(-1, self.num_heads, 1, self.head_dim)
+        out = F.scaled_dot_product_attention(
+            q,
+            split_heads(k),
+            split_heads(v),
+            attn_mask=attn_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+        )
+        return self.out_proj(out.reshape(1, -1, D))
+
+
+class FusedMultiheadAttention(nn.Module):
+    """
+    Batch-first multi-head attention on F.scaled_dot_product_attention
+
+    Holds the parameters of nn.MultiheadAttention under the same names, so
+    trunks built with MultiheadAttention load into it unchanged, and takes
+    inputs of shape B x L x D, so trunks need no rearranges around it.
+
+    Args:
+        causal (bool): Whether the L x L masks it is given are causal masks,
+            which SDPA then applies with is_causal instead of reading them
+    """
+
+    batch_first = True
+
+    def __init__(
+        self,
+        embed_dim,
+        num_heads,
+        dropout=0.0,
+        bias=True,
+        add_bias_kv=False,
+        causal=False,
+    ):
+        super().__init__()
+        if embed_dim % num_heads != 0:
+            raise ValueError(
+                f"embed_dim {embed_dim} is not divisible by num_heads {num_heads}"
+            )
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+        self.dropout = dropout
+        self.causal = causal
+
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        if bias:
+            self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        else:
+            self.register_parameter("in_proj_bias", None)
+        self.out_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
+        if add_bias_kv:
+            self.bias_k = nn.Parameter(torch.empty(1, 1, embed_dim))
+            self.bias_v = nn.Parameter(torch.empty(1, 1, embed_dim))
+        else:
+            self.bias_k = self.bias_v = None
+        self._reset_parameters()
+
+    def _reset_parameters(self):
+        # as nn.MultiheadAttention
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        if self.in_proj_bias is not None:
+            nn.init.constant_(self.in_proj_bias, 0.0)
+            nn.init.constant_(self.out_proj.bias, 0.0)
+        if self.bias_k is not None:
+            nn.init.xavier_normal_(self.bias_k)
+            nn.init.xavier_normal_(self.bias_v)
+
+    def _split_heads(self, t: torch.Tensor):
+        # B x L x D -> B x heads x L x head_dim
+        return t.unflatten(-1, (self.num_heads, self.head_dim)).transpose(1, 2)
+
+    def _attend(self, q, k, v, attn_mask, is_causal=False):
+        """
+        Attends queries of shape B x Lq x D over keys and values of shape
+        B x Lk x D, followed by bias_k and bias_v if any, and applies the
+        output projection
+        """
+        if self.bias_k is not None:
+            B = k.shape[0]
+            k = torch.cat([k, self.bias_k.expand(B, -1, -1)], dim=1)
+            v = torch.cat([v, self.bias_v.expand(B, -1, -1)], dim=1)
+            if attn_mask is not None:
+                attn_mask = F.pad(attn_mask, (0, 1))
+        if attn_mask is not None and attn_mask.ndim == 3:
+            # one mask per sequence, shared by its heads
+            attn_mask = attn_mask.unsqueeze(1)
+        out = F.scaled_dot_product_attention(
+            self._split_heads(q),
+            self._split_heads(k),
+            self._split_heads(v),
+            attn_mask=attn_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+            is_causal=is_causal,
+        )
+        return self.out_proj(out.transpose(1, 2).flatten(2))
+
+    def forward(self, x: torch.Tensor, attn_mask: torch.Tensor):
+        is_causal = False
+        if (
+            self.causal
+            and attn_mask is not None
+            and attn_mask.ndim == 2
+            and self.bias_k is None
+        ):
+            attn_mask, is_causal = None, True
+        q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        return self._attend(q, k, v, attn_mask, is_causal)
+
+    def project_kv(self, x: torch.Tensor):
+        """
+        Returns the keys and values of x, of shape B x L x D, before the
+        split into heads
+        """
+        _, w_k, w_v = self.in_proj_weight.chunk(3)
+        _, b_k, b_v = (
+            self.in_proj_bias.chunk(3) if self.in_proj_bias is not None else (None,) * 3
+        )
+        return F.linear(x, w_k, b_k), F.linear(x, w_v, b_v)
+
+    def forward_with_past(
+        self, x: torch.Tensor, past_kv: tuple, attn_mask: torch.Tensor
+    ):
+        """
+        Batch-first MultiheadAttention.forward_with_past: x is B x L x D and
+        past_kv holds tensors of shape 1 x P x D or B x P x D
+        """
+        B = x.shape[0]
+        q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        past_k, past_v = past_kv
+        k = torch.cat([past_k.expand(B, -1, -1), k], dim=1)
+        v = torch.cat([past_v.expand(B, -1, -1), v], dim=1)
+        return self._attend(q, k, v, attn_mask)
+
+    def forward_pooled(self, x: torch.Tensor, attn_mask: torch.Tensor, pool_tokens):
+        """
+        Batch-first MultiheadAttention.forward_pooled: x is B x L x D and the
+        outputs of the N pooled tokens are returned as N x 1 x D
+        """
+        B, L, D = x.shape
+        rows, positions = pool_index(pool_tokens, B, x.device)
+        w_q, w_kv = self.in_proj_weight.split([D, 2 * D])
+        b_q, b_kv = (
+            self.in_proj_bias.split([D, 2 * D])
+            if self.in_proj_bias is not None
+            else (None, None)
+        )
+        q = F.linear(x[rows, positions], w_q, b_q).unsqueeze(1)
+        k, v = F.linear(x, w_kv, b_kv).chunk(2, dim=-1)
+        if attn_mask is not None:
+            if attn_mask.ndim == 2:
+                attn_mask = attn_mask[positions]
+            else:
+                attn_mask = attn_mask[rows, positions]
+            attn_mask = attn_mask.reshape(-1, 1, L)
+        return self._attend(q, k[rows], v[rows], attn_mask)
+
 
 class ViTAttention(Attention):
     def forward(self, x: torch.Tensor, attn_mask: torch.Tensor):
@@ -170,6 +433,41 @@ class BlockWithMasking(nn.Module):
             x = x + self.drop_path(self.mlp(self.norm_2(x))) * self.layer_scale_gamma2
         return x
 
+    def forward_with_past(self, x: torch.Tensor, past_kv: tuple, attn_mask):
+        """
+        Runs the block on tokens following a prefix whose keys and values for
+        this block are past_kv, see MultiheadAttention.forward_with_past
+        """
+        attn = self.attn.forward_with_past(self.norm_1(x), past_kv, attn_mask)
+        if self.layer_scale_type is None:
+            x = x + self.drop_path(attn)
+            x = x + self.drop_path(self.mlp(self.norm_2(x)))
+        else:
+            x = x + self.drop_path(attn) * self.layer_scale_gamma1
+            x = x + self.drop_path(self.mlp(self.norm_2(x))) * self.layer_scale_gamma2
+        return x
+
+    def forward_pooled(self, x: torch.Tensor, attn_mask: torch.Tensor, pool_tokens):
+        """
+        Runs the block for the pooled tokens only, whose attention still reads
+        every token, see MultiheadAttention.forward_pooled. Returns their
+        1 x N x D outputs, or N x 1 x D with batch-first attention.
+        """
+        attn = self.attn.forward_pooled(self.norm_1(x), attn_mask, pool_tokens)
+        if getattr(self.attn, "batch_first", False):
+            rows, positions = pool_index(pool_tokens, x.shape[0], x.device)
+            x = x[rows, positions].unsqueeze(1)
+        else:
+            rows, positions = pool_index(pool_tokens, x.shape[1], x.device)
+            x = x[positions, rows].unsqueeze(0)
+        if self.layer_scale_type is None:
+            x = x + self.drop_path(attn)
+            x = x + self.drop_path(self.mlp(self.norm_2(x)))
+        else:
+            x = x + self.drop_path(attn) * self.layer_scale_gamma1
+            x = x + self.drop_path(self.mlp(self.norm_2(x))) * self.layer_scale_gamma2
+        return x
+
 
 _LAYER_NORM = partial(nn.LayerNorm, eps=1e-6)
 
@@ -203,7 +501,11 @@ class SimpleTransformer(nn.Module):
         super().__init__()
         self.pre_transformer_layer = pre_transformer_layer
         if drop_path_type == "progressive":
-            dpr = [x.item() for x in torch.linspace(0, drop_path_rate, num_blocks)]
+            # computed on the CPU so the trunk can also be built on the meta device
+            dpr = [
+                x.item()
+                for x in torch.linspace(0, drop_path_rate, num_blocks, device="cpu")
+            ]
         elif drop_path_type == "uniform":
             dpr = [drop_path_rate for i in range(num_blocks)]
         else:
@@ -250,14 +552,20 @@ class SimpleTransformer(nn.Module):
         use_checkpoint: bool = False,
         checkpoint_every_n: int = 1,
         checkpoint_blk_ids: List[int] = None,
+        pool_tokens: tuple = None,
     ):
         """
         Inputs
         - tokens: data of shape N x L x D (or L x N x D depending on the attention implementation)
         - attn: mask of shape L x L
+        - pool_tokens: the (rows, positions) of the tokens the head reads, see
+          MultiheadAttention.forward_pooled. If given, the final block only
+          computes those tokens, which requires MultiheadAttention or
+          FusedMultiheadAttention blocks.
 
         Output
-        - x: data of shape N x L x D (or L x N x D depending on the attention implementation)
+        - x: data of shape N x L x D (or L x N x D depending on the attention implementation),
+          or N x 1 x D (or 1 x N x D) with pool_tokens
         """
         if self.pre_transformer_layer:
             tokens = self.pre_transformer_layer(tokens)
@@ -270,6 +578,8 @@ class SimpleTransformer(nn.Module):
         if checkpoint_blk_ids:
             checkpoint_blk_ids = set(checkpoint_blk_ids)
         for blk_id, blk in enumerate(self.blocks):
+            if pool_tokens is not None and blk_id == len(self.blocks) - 1:
+                blk = partial(blk.forward_pooled, pool_tokens=pool_tokens)
             if use_checkpoint and blk_id in checkpoint_blk_ids:
                 tokens = checkpoint.checkpoint(
                     blk, tokens, attn_mask, use_reentrant=False
@@ -279,3 +589,40 @@ class SimpleTransformer(nn.Module):
         if self.post_transformer_layer:
             tokens = self.post_transformer_layer(tokens)
         return tokens
+
+    def compute_prefix(self, tokens: torch.Tensor, attn_mask: torch.Tensor = None):
+        """
+        Runs a prefix through the trunk and returns the keys and values of its
+        tokens at every block, for forward_with_prefix. Requires
+        MultiheadAttention or FusedMultiheadAttention blocks.
+
+        Inputs
+        - tokens: data of shape 1 x P x D
+        - attn_mask: mask of shape P x P
+        """
+        if self.pre_transformer_layer:
+            tokens = self.pre_transformer_layer(tokens)
+        prefix_kv = []
+        for blk in self.blocks:
+            prefix_kv.append(blk.attn.project_kv(blk.norm_1(tokens)))
+            tokens = blk(tokens, attn_mask=attn_mask)
+        return prefix_kv
+
+    def forward_with_prefix(
+        self, tokens: torch.Tensor, prefix_kv: list, attn_mask: torch.Tensor = None
+    ):
+        """
+        Runs tokens that follow a prefix through the trunk, attending over the
+        prefix keys and values from compute_prefix instead of recomputing them
+
+        Inputs
+        - tokens: data of shape N x L x D
+        - attn_mask: mask of shape L x (P + L)
+        """
+        if self.pre_transformer_layer:
+            tokens = self.pre_transformer_layer(tokens)
+        for blk, past_kv in zip(self.blocks, prefix_kv):
+            tokens = blk.forward_with_past(tokens, past_kv, attn_mask)
+        if self.post_transformer_layer:
+            tokens = self.post_transformer_layer(tokens)
+        return tokens
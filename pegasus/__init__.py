@@ -1 +1,14 @@
-from pegasus.main import Pegasus
+__all__ = ["Pegasus", "ZeroShotClassifier"]
+
+
+def __getattr__(name):
+    # Pegasus pulls in torch and the model, so it is only imported when used
+    if name == "Pegasus":
+        from pegasus.main import Pegasus
+
+        return Pegasus
+    if name == "ZeroShotClassifier":
+        from pegasus.zero_shot import ZeroShotClassifier
+
+        return ZeroShotClassifier
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DynamicBatcher:
+    """
+    Collects concurrent embedding requests into batches for a single modality
+
+    Requests are queued until max_batch items are waiting or max_wait_ms has
+    passed since the first one arrived. The batch then runs through embed_fn in
+    the given executor, typically a dedicated inference thread, while new
+    requests keep queueing for the next batch, and each caller gets its own row.
+
+    Inputs:
+        embed_fn: A callable taking a list of items and returning an (N, D) array
+        executor: The executor embed_fn runs in, None for the loop's default one
+        max_batch: The maximum number of items per batch
+        max_wait_ms: How long to wait for more items once a batch is started
+    """
+
+    def __init__(self, embed_fn, executor=None, max_batch=32, max_wait_ms=5.0):
+        if not isinstance(max_batch, int) or max_batch < 1:
+            raise ValueError("max_batch should be a positive integer")
+        if max_wait_ms < 0:
+            raise ValueError("max_wait_ms should not be negative")
+
+        self.embed_fn = embed_fn
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._loop = None
+        self._queue = None
+        self._task = None
+
+    def _start(self):
+        """
+        Starts the batching task on the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._task = loop.create_task(self._run())
+
+    async def submit(self, item):
+        """
+        Queues an item and waits for its embedding
+
+        Inputs:
+            item: A single input item, e.g. a text or a file path
+
+        Returns:
+            the embedding of the item
+        """
+        self._start()
+        future = self._loop.create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def _next_batch(self):
+        """
+        Waits for the first request, then collects more until the batch is
+        full or max_wait_ms has passed
+        """
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = await self._next_batch()
+                batch = [(item, future) for item, future in batch if not future.done()]
+                if not batch:
+                    continue
+                try:
+                    embeddings = await self._loop.run_in_executor(
+                        self.executor, self.embed_fn, [item for item, _ in batch]
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to embed batch: {str(e)}")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, future), embedding in zip(batch, embeddings):
+                    if not future.done():
+                        future.set_result(embedding)
+                batch = []
+        except asyncio.CancelledError:
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            for _, future in batch:
+                future.cancel()
+            raise
+
+    def close(self):
+        """
+        Stops the batching task, cancelling the requests still waiting
+        """
+        if (
+            self._task is not None
+            and not self._task.done()
+            and not self._loop.is_closed()
+        ):
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        self._task = None
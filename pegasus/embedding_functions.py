@@ -1,63 +1,265 @@
+import logging
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import torch
 
-from pegasus.ImageBind.models.imagebind_model import (
-    ModalityType,
-    imagebind_model,
+from pegasus.ImageBind.data import (
     load_and_transform_audio_data,
     load_and_transform_text,
     load_and_transform_vision_data,
+    split_text_windows,
 )
+from pegasus.ImageBind.models.imagebind_model import (
+    DEFAULT_CHECKPOINT_PATH,
+    ModalityType,
+)
+from pegasus.registry import PRECISIONS, model_registry
 from pegasus.types import Documents, EmbeddingFunction, Embeddings
 
+logger = logging.getLogger(__name__)
 
-class MultiModalEmbeddingFunction(EmbeddingFunction):
-    _model_cache = {}
+RETURN_FORMATS = ("list", "numpy", "torch")
+
+POOLINGS = ("mean", "length")
+
+
+def format_embeddings(embeddings, return_format="list", out=None):
+    """
+    Converts a batch of embeddings to the requested output format
+
+    Args:
+        embeddings (torch.Tensor): The (N, D) embeddings computed by the model.
+        return_format (str): "list" for a list of lists, "numpy" for a single
+            (N, D) float32 ndarray or "torch" for a (N, D) float32 tensor.
+        out (np.ndarray or torch.Tensor): Optional preallocated (N, D) float32
+            buffer, e.g. a slice of a memmap, that the embeddings are written
+            into. It is returned as is when given.
+    Returns:
+        The embeddings in the requested format.
+    """
+    if return_format not in RETURN_FORMATS:
+        raise ValueError(
+            f"Invalid return_format: {return_format}, expected one of {RETURN_FORMATS}"
+        )
+
+    embeddings = embeddings.detach().to(dtype=torch.float32)
+
+    if out is not None:
+        if tuple(out.shape) != tuple(embeddings.shape):
+            raise ValueError(
+                f"Expected out to have shape {tuple(embeddings.shape)}, got {tuple(out.shape)}"
+            )
+        if isinstance(out, torch.Tensor):
+            out.copy_(embeddings)
+        else:
+            out[...] = embeddings.cpu().numpy()
+        return out
+
+    if return_format == "torch":
+        return embeddings.contiguous()
 
+    embeddings_array = embeddings.cpu().numpy()
+    if return_format == "numpy":
+        return embeddings_array
+    return embeddings_array.tolist()
+
+
+def pool_windows(embeddings, lengths, pooling="mean"):
+    """
+    Pools the W x D embeddings of the windows of a text into one embedding
+    with the mean norm of the windows
+    """
+    if pooling == "length":
+        # an empty text still has one window, of its start and end tokens
+        weights = embeddings.new_tensor(lengths).clamp_min(1)
+    else:
+        weights = embeddings.new_ones(len(lengths))
+    pooled = (embeddings * weights[:, None]).sum(dim=0) / weights.sum()
+    norm = embeddings.norm(dim=-1).mean()
+    return pooled * (norm / pooled.norm().clamp_min(1e-12))
+
+
+class MultiModalEmbeddingFunction(EmbeddingFunction):
     def __init__(
         self,
         modality: str = ModalityType,  # type: ignore
         model_path: str = "https://dl.fbaipublicfiles.com/imagebind/imagebind_huge.pth",
         device: str = "cuda:0",
+        checkpoint_path: str = DEFAULT_CHECKPOINT_PATH,
+        precision: str = "fp32",
+        adapter: str = None,
+        modalities: list = None,
+        registry=None,
+        pack_text: bool = False,
     ):
         self._modality = modality
         self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
-        self._model = imagebind_model.imagebind_huge(pretrained=True)
-        self._model.eval()
-        self._model.to(self.device)
-
-    def __call__(self, *args: Documents) -> Embeddings:
-        if self._modality == ModalityType.TEXT:
-            inputs = {ModalityType.TEXT: load_and_transform_text(args[0], self.device)}
-            print("Inputs:", inputs)
-        elif self._modality == ModalityType.VISION:
-            inputs = {
-                ModalityType.VISION: load_and_transform_vision_data(
-                    args[0], self.device
-                )
-            }
-        elif self._modality == ModalityType.AUDIO:
-            inputs = {
-                ModalityType.AUDIO: load_and_transform_audio_data(args[0], self.device)
-            }
+        self.dtype = PRECISIONS.get(precision)
+        # the model is shared through the registry with every other embedding
+        # function asking for the same weights, whatever their modality
+        self._registry = registry or model_registry
+        self._model = self._registry.acquire(
+            checkpoint_path, precision, adapter, self.device, modalities, pack_text
+        )
+
+    def close(self):
+        """
+        Releases the model back to the registry
+        """
+        if getattr(self, "_model", None) is not None:
+            self._registry.release(self._model)
+            self._model = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def _load_inputs(self, modality: str, data):
+        if modality == ModalityType.TEXT:
+            inputs = load_and_transform_text(data, self.device)
+        elif modality == ModalityType.VISION:
+            inputs = load_and_transform_vision_data(data, self.device)
+        elif modality == ModalityType.AUDIO:
+            inputs = load_and_transform_audio_data(data, self.device)
         else:
             raise ValueError("Invalid modality specified")
+        if inputs.is_floating_point():
+            inputs = inputs.to(self.dtype)
+        return inputs
+
+    def __call__(
+        self,
+        *args: Documents,
+        modality: str = None,
+        return_format: str = "list",
+        out=None,
+    ) -> Embeddings:
+        # the model holds every modality tower, so one instance can serve them all
+        modality = modality or self._modality
+        inputs = {modality: self._load_inputs(modality, args[0])}
+
+        logger.debug("Inputs: %s", inputs)
 
         with torch.no_grad():
             embeddings = self._model(inputs)
 
-        print("Embeddings:", embeddings)
+        logger.debug("Embeddings: %s", embeddings)
 
-        # Convert the embeddings tensor to a NumPy array and then to a list of lists (embeddings)
-        embeddings_array = embeddings[self._modality].cpu().numpy()
+        return format_embeddings(embeddings[modality], return_format, out)
 
-        print("Embeddings array:", embeddings_array)
-        # embeddings_list = embeddings_array.tolist()
+    def embed_multi(self, data: dict, return_format: str = "list") -> dict:
+        """
+        Embeds inputs of several modalities in a single forward pass.
+        Args:
+            data (dict): Maps each modality to its texts or file paths.
+            return_format (str): "list", "numpy" or "torch", see format_embeddings.
+        Returns:
+            A dict mapping each modality to its embeddings.
+        """
+        inputs = {
+            modality: self._load_inputs(modality, modality_data)
+            for modality, modality_data in data.items()
+        }
 
-        # return embeddings_list
+        logger.debug("Inputs: %s", inputs)
 
-        return [embedding.tolist() for embedding in embeddings_array]
+        with torch.no_grad():
+            embeddings = self._model(inputs)
+
+        logger.debug("Embeddings: %s", embeddings)
+
+        return {
+            modality: format_embeddings(embeddings[modality], return_format)
+            for modality in data
+        }
+
+    def embed_long_text(
+        self,
+        documents,
+        window_overlap: int = 16,
+        batch_size: int = 32,
+        pooling: str = "mean",
+        return_format: str = "list",
+    ):
+        """
+        Embeds texts of any length by splitting them into overlapping token
+        windows and pooling the embeddings of each text's windows.
+        Windows of consecutive texts share forward passes of batch_size windows,
+        and texts are pulled from documents as windows are needed, so it can be
+        a generator over an arbitrarily large corpus.
+        Args:
+            documents (Iterable[str]): The texts to embed.
+            window_overlap (int): The number of tokens shared by consecutive windows.
+            batch_size (int): The number of windows per forward pass.
+            pooling (str): "mean" to average the windows of a text, "length" to
+                weight them by their number of tokens. The pooled embedding is
+                rescaled to the mean norm of its windows.
+            return_format (str): "list", "numpy" or "torch", see format_embeddings.
+        Returns:
+            A generator of (indices, embeddings) for the texts completed by each
+            forward pass, in order, where indices is an int64 ndarray of their
+            positions.
+        """
+        if pooling not in POOLINGS:
+            raise ValueError(f"Invalid pooling: {pooling}, expected one of {POOLINGS}")
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("batch_size should be a positive integer")
+        if return_format not in RETURN_FORMATS:
+            raise ValueError(
+                f"Invalid return_format: {return_format}, expected one of {RETURN_FORMATS}"
+            )
+        # validated above rather than in the generator, so that bad arguments
+        # fail at the call instead of on the first next()
+        return self._embed_long_text(
+            documents, window_overlap, batch_size, pooling, return_format
+        )
+
+    def _embed_long_text(
+        self, documents, window_overlap, batch_size, pooling, return_format
+    ):
+        """
+        The generator behind embed_long_text, with validated arguments.
+        """
+        pending = deque()
+        rows, owners = [], []
+
+        def run_batch():
+            tokens = torch.stack(rows[:batch_size]).to(self.device)
+            batch_owners = owners[:batch_size]
+            del rows[:batch_size], owners[:batch_size]
+            with torch.no_grad():
+                embeddings = self._model({ModalityType.TEXT: tokens})[ModalityType.TEXT]
+            for owner, embedding in zip(batch_owners, embeddings):
+                owner["windows"].append(embedding)
+
+            indices, pooled = [], []
+            while pending and len(pending[0]["windows"]) == len(pending[0]["lengths"]):
+                document = pending.popleft()
+                indices.append(document["index"])
+                pooled.append(
+                    pool_windows(
+                        torch.stack(document["windows"]), document["lengths"], pooling
+                    )
+                )
+            if pooled:
+                yield np.array(indices, dtype=np.int64), format_embeddings(
+                    torch.stack(pooled), return_format
+                )
+
+        for index, text in enumerate(documents):
+            tokens, lengths = split_text_windows(text, overlap=window_overlap)
+            document = {"index": index, "lengths": lengths, "windows": []}
+            pending.append(document)
+            rows.extend(tokens)
+            owners.extend([document] * len(tokens))
+            while len(rows) >= batch_size:
+                yield from run_batch()
+        while rows:
+            yield from run_batch()
 
 
 """
@@ -70,22 +272,23 @@ audio_embedding_function = MultiModalEmbeddingFunction(modality=ModalityType.AUD
 
 # ouptu to parquet?
 
-import logging
-from concurrent.futures import ThreadPoolExecutor
-
 
 class OptimizedMultiModalEmbeddingFunction(EmbeddingFunction):
     """
     Class to handle multi-modal embeddings with error handling and logging.
     """
 
-    _model_cache = {}
-
     def __init__(
         self,
         modality: str = ModalityType,
         model_path: str = "https://dl.fbaipublicfiles.com/imagebind/imagebind_huge.pth",
         device: str = "cuda:0",
+        checkpoint_path: str = DEFAULT_CHECKPOINT_PATH,
+        precision: str = "fp32",
+        adapter: str = None,
+        modalities: list = None,
+        registry=None,
+        pack_text: bool = False,
     ):
         """
         Initialize the embedding function with specified modality and device.
@@ -93,32 +296,71 @@ class OptimizedMultiModalEmbeddingFunction(EmbeddingFunction):
             modality (str): The type of modality - 'TEXT', 'VISION', 'AUDIO'.
             model_path (str): Path to the model file.
             device (str): The device to run the model on - 'cpu' or 'cuda'.
+            checkpoint_path (str): Path to the imagebind_huge checkpoint.
+            precision (str): The model precision - 'fp32', 'fp16' or 'bf16'.
+            adapter (str): Optional path to a state dict loaded over the checkpoint.
+            modalities (list): The modality towers to build, defaults to the
+                embedding function's own modality.
+            registry (ModelRegistry): The registry the model is shared through,
+                defaults to the process-wide one.
+            pack_text (bool): Whether to pack several short texts per text
+                trunk row, which speeds up embedding many short texts.
         """
         self._modality = modality
         self.device = (
             device if torch.cuda.is_available() and "cuda" in device else "cpu"
         )
         self.model_path = model_path
+        self.checkpoint_path = checkpoint_path
+        self.precision = precision
+        self.adapter = adapter
+        self.modalities = modalities or [modality]
+        self.pack_text = pack_text
+        self._registry = registry or model_registry
+        self._model = None
 
     def _load_model(self):
         """
-        Load model and store it in cache for reusability.
+        Acquire the model from the registry, shared with every other embedding
+        function using the same weights, on first use.
+        """
+        if self._model is None:
+            self._model = self._registry.acquire(
+                self.checkpoint_path,
+                self.precision,
+                self.adapter,
+                self.device,
+                self.modalities,
+                self.pack_text,
+            )
+
+        return self._model
+
+    def close(self):
         """
-        if (self._modality, self.device) not in self._model_cache:
-            model = imagebind_model.imagebind_huge(pretrained=True)
-            model.eval()
-            model.to(self.device)
-            self._model_cache[(self._modality, self.device)] = model
+        Release the model back to the registry.
+        """
+        if getattr(self, "_model", None) is not None:
+            self._registry.release(self._model)
+            self._model = None
 
-        return self._model_cache[(self._modality, self.device)]
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
 
-    def __call__(self, *args: Documents) -> Embeddings:
+    def __call__(
+        self, *args: Documents, return_format: str = "list", out=None
+    ) -> Embeddings:
         """
         Main function call to compute embeddings.
         Args:
             args (Documents): Text, video file path, or audio file path.
+            return_format (str): "list", "numpy" or "torch", see format_embeddings.
+            out (np.ndarray or torch.Tensor): Optional preallocated output buffer.
         Returns:
-            Embeddings as a list of lists.
+            Embeddings as a list of lists, or a single (N, D) float32 array.
         """
         model = self._load_model()
         load_func = {
@@ -135,7 +377,10 @@ class OptimizedMultiModalEmbeddingFunction(EmbeddingFunction):
         try:
             with ThreadPoolExecutor() as executor:
                 future = executor.submit(load_func, args[0], self.device)
-                inputs = {self._modality: future.result()}
+                inputs = future.result()
+            if inputs.is_floating_point():
+                inputs = inputs.to(PRECISIONS[self.precision])
+            inputs = {self._modality: inputs}
         except Exception as e:
             logging.error(f"Failed to load input data: {str(e)}")
             raise
@@ -150,11 +395,13 @@ class OptimizedMultiModalEmbeddingFunction(EmbeddingFunction):
         del inputs  # Delete the input tensors to free up memory
 
         try:
-            embeddings_array = embeddings[self._modality].cpu().numpy()
+            embeddings_array = format_embeddings(
+                embeddings[self._modality], return_format, out
+            )
         except Exception as e:
-            logging.error(f"Failed to convert embeddings to numpy array: {str(e)}")
+            logging.error(f"Failed to convert embeddings: {str(e)}")
             raise
 
         del embeddings  # Delete the output tensor to free up memory
 
-        return [embedding.tolist() for embedding in embeddings_array]
+        return embeddings_array
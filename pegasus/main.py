@@ -1,10 +1,25 @@
 import logging
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import math
+import os
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 
 import numpy as np
+import torch
 
-from pegasus.embedding_functions import MultiModalEmbeddingFunction
-
+from pegasus.batching import DynamicBatcher
+from pegasus.ImageBind.models.imagebind_model import EMBED_DIM
+from pegasus.embedding_functions import (
+    POOLINGS,
+    RETURN_FORMATS,
+    MultiModalEmbeddingFunction,
+)
 
 # logging
 logging.basicConfig(
@@ -33,6 +48,312 @@ def optimized_embedding_function(modality, data):
         raise
 
 
+# Embedding function owned by each worker of a Pegasus process pool. It is
+# built once by the pool initializer so the model is loaded once per worker.
+_worker_embedding_function = None
+
+
+def _init_worker(modality, modalities=None, pack_text=False):
+    """
+    Initializer for the Pegasus process pool, loads the model once per worker
+
+    inputs:
+        modality: A string representing the modality in lower case 'text' 'vision' 'audio'
+        modalities: The modality towers to build, None for all of them
+        pack_text: Whether to pack several short texts per text trunk row
+    """
+    global _worker_embedding_function
+    try:
+        _worker_embedding_function = MultiModalEmbeddingFunction(
+            modality, modalities=modalities, pack_text=pack_text
+        )
+    except Exception as e:
+        logger.error(f"Failed to initialize worker: {str(e)}")
+        raise
+
+
+def _embed_in_worker(data, return_format="list"):
+    """
+    Embeds the data with the embedding function preloaded in this worker
+
+    inputs:
+        data: A numpy array representing the data
+        return_format: "list" or "numpy", the format the embeddings are sent back in
+
+    Returns:
+        the embeddings generated by MultiModalEmbeddingFunction
+    """
+    try:
+        return _worker_embedding_function(data, return_format=return_format)
+    except Exception as e:
+        logger.error(f"Failed to generate embeddings: {str(e)}")
+        raise
+
+
+def _item_nbytes(item, modality):
+    """
+    Estimates the size of a single input item in bytes
+
+    inputs:
+        item: A text string, a file path or an array
+        modality: A string representing the modality in lower case 'text' 'vision' 'audio'
+
+    Returns:
+        the size of the text, of the file the path points to, or of the array
+    """
+    if isinstance(item, (bytes, bytearray)):
+        return len(item)
+    if isinstance(item, str):
+        if modality != "text" and os.path.isfile(item):
+            return os.path.getsize(item)
+        return len(item.encode("utf-8"))
+    return getattr(item, "nbytes", 0)
+
+
+def _as_array(data):
+    """
+    Converts input items to a numpy array without altering them
+
+    Encoded bytes, arrays and tensors are kept as they are in an object array,
+    where np.array would strip the trailing null bytes of bytes and merge
+    arrays into a single block.
+    """
+    if isinstance(data, torch.Tensor) or (
+        isinstance(data, (list, tuple))
+        and any(
+            isinstance(item, (bytes, bytearray, np.ndarray, torch.Tensor))
+            for item in data
+        )
+    ):
+        items = np.empty(len(data), dtype=object)
+        for index, item in enumerate(data):
+            items[index] = item
+        return items
+    return np.array(data)
+
+
+def _iter_batches(data, modality, batch_size=None, max_batch_bytes=None):
+    """
+    Splits the data into consecutive micro-batches
+
+    inputs:
+        data: A numpy array or a list representing the data
+        modality: A string representing the modality in lower case 'text' 'vision' 'audio'
+        batch_size: The maximum number of items per batch, None for no limit
+        max_batch_bytes: The maximum estimated size of a batch in bytes, None for no limit.
+            An item larger than the limit is placed in a batch of its own
+
+    Yields:
+        (start, batch) tuples where batch is data[start:start + len(batch)]
+    """
+    n = len(data)
+    batch_size = batch_size or max(n, 1)
+    start = 0
+    while start < n:
+        stop = min(start + batch_size, n)
+        if max_batch_bytes is not None:
+            total = 0
+            for i in range(start, stop):
+                total += _item_nbytes(data[i], modality)
+                if total > max_batch_bytes and i > start:
+                    stop = i
+                    break
+        yield start, data[start:stop]
+        start = stop
+
+
+def _embed_multi_in_worker(data, return_format="list"):
+    """
+    Embeds inputs of several modalities in one forward pass in this worker
+
+    inputs:
+        data: A dict mapping each modality to a batch of its data
+        return_format: "list" or "numpy", the format the embeddings are sent back in
+
+    Returns:
+        a dict mapping each modality to its embeddings
+    """
+    try:
+        return _worker_embedding_function.embed_multi(data, return_format=return_format)
+    except Exception as e:
+        logger.error(f"Failed to generate embeddings: {str(e)}")
+        raise
+
+
+def _iter_multi_batches(data, batch_size=None, max_batch_bytes=None):
+    """
+    Splits inputs of several modalities into rounds of micro-batches
+
+    inputs:
+        data: A dict mapping each modality to a numpy array or a list of its data
+        batch_size: The maximum number of items per batch of each modality
+        max_batch_bytes: The maximum estimated size of a batch in bytes
+
+    Yields:
+        dicts mapping each modality that still has data to a (start, batch) tuple
+    """
+    batches = {
+        modality: _iter_batches(modality_data, modality, batch_size, max_batch_bytes)
+        for modality, modality_data in data.items()
+    }
+    while batches:
+        round_batches = {}
+        for modality in list(batches):
+            next_batch = next(batches[modality], None)
+            if next_batch is None:
+                del batches[modality]
+            else:
+                round_batches[modality] = next_batch
+        if round_batches:
+            yield round_batches
+
+
+def _iter_stream_batches(iterable, modality, batch_size, max_batch_bytes=None):
+    """
+    Lazily groups the items of an iterable into consecutive micro-batches
+
+    inputs:
+        iterable: Any iterable of input items, consumed one item at a time
+        modality: A string representing the modality in lower case 'text' 'vision' 'audio'
+        batch_size: The maximum number of items per batch
+        max_batch_bytes: The maximum estimated size of a batch in bytes, None for no limit
+
+    Yields:
+        (start, batch) tuples where batch is a list of items and start the index
+        of its first item in the iterable
+    """
+    start = 0
+    batch = []
+    batch_bytes = 0
+    for item in iterable:
+        item_bytes = 0 if max_batch_bytes is None else _item_nbytes(item, modality)
+        if batch and (
+            len(batch) >= batch_size
+            or (
+                max_batch_bytes is not None
+                and batch_bytes + item_bytes > max_batch_bytes
+            )
+        ):
+            yield start, batch
+            start += len(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(item)
+        batch_bytes += item_bytes
+    if batch:
+        yield start, batch
+
+
+def _submit_bounded(executor, fn, jobs, prefetch):
+    """
+    Runs jobs on a pool with a bounded number of them in flight
+
+    inputs:
+        executor: The pool the jobs are submitted to
+        fn: The function each job calls
+        jobs: An iterable of (key, args) tuples, consumed as jobs complete
+        prefetch: The maximum number of jobs in flight
+
+    Yields:
+        (key, result) for each job as soon as it completes, which may be out of order
+    """
+    in_flight = {}
+    try:
+        for key, args in jobs:
+            in_flight[executor.submit(fn, *args)] = key
+            if len(in_flight) >= prefetch:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield in_flight.pop(future), future.result()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future.result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+class _EmbeddingCollector:
+    """
+    Reassembles per-batch embeddings in input order
+
+    inputs:
+        n: The total number of items
+        return_format: "list", "numpy" or "torch"
+        out: Optional preallocated (n, D) float32 ndarray, memmap or tensor
+        dim: The embedding size D of an empty result
+
+    Batches may be added in any order. With "numpy" and "torch" each batch is
+    written into the (n, D) buffer as it is added, so no batch is kept around
+    """
+
+    def __init__(self, n, return_format="list", out=None, dim=EMBED_DIM):
+        self.n = n
+        self.return_format = return_format
+        self.out = out
+        self.dim = dim
+        self.buffer = out
+        self.batches = {}
+
+    def add(self, start, batch_embeddings):
+        """
+        Adds the embeddings of the batch whose first item is at start, a list of
+        lists with the "list" format and a float32 ndarray otherwise
+        """
+        if self.return_format == "list":
+            self.batches[start] = batch_embeddings
+            return
+        if self.buffer is None:
+            self.buffer = np.empty(
+                (self.n, batch_embeddings.shape[1]), dtype=np.float32
+            )
+        stop = start + len(batch_embeddings)
+        if isinstance(self.buffer, torch.Tensor):
+            self.buffer[start:stop].copy_(torch.from_numpy(batch_embeddings))
+        else:
+            self.buffer[start:stop] = batch_embeddings
+
+    def result(self):
+        """
+        Returns a list of lists, or a single (n, D) float32 ndarray or tensor
+        """
+        if self.return_format == "list":
+            embeddings = []
+            for start in sorted(self.batches):
+                embeddings.extend(self.batches[start])
+            return embeddings
+        if self.out is not None:
+            return self.out
+        buffer = self.buffer
+        if buffer is None:
+            buffer = np.empty((0, self.dim), dtype=np.float32)
+        if self.return_format == "torch":
+            return torch.from_numpy(buffer)
+        return buffer
+
+
+def _collect_embeddings(results, n, return_format="list", out=None, dim=EMBED_DIM):
+    """
+    Reassembles per-batch embeddings in input order
+
+    inputs:
+        results: An iterable of (start, embeddings) tuples, one per batch, where
+            embeddings is a list of lists or a float32 ndarray
+        n: The total number of items
+        return_format: "list", "numpy" or "torch"
+        out: Optional preallocated (n, D) float32 ndarray, memmap or tensor
+        dim: The embedding size D of an empty result
+
+    Returns:
+        a list of lists, or a single (n, D) float32 ndarray or tensor
+    """
+    collector = _EmbeddingCollector(n, return_format, out, dim)
+    for start, batch_embeddings in results:
+        collector.add(start, batch_embeddings)
+    return collector.result()
+
+
 class Pegasus:
     """
     Pegasus is the main multi-modal embedding class
@@ -41,9 +362,29 @@ class Pegasus:
         modality: A string representing the modality => "text' 'audio'
         multi_process: A boolean indicating if multiprocessing will be enabled
         n_processes: An integer indicating that the number of processes to use
+        max_batch: The maximum number of concurrent aembed requests per batch
+        max_wait_ms: How long aembed waits for more requests before running a batch
+        modalities: The modality towers to build in the model, None for all of them.
+            e.g. ["text"] keeps a text-only worker from loading the vision and audio towers
+        pack_text: Whether to pack several short texts into each row of the text
+            trunk, which speeds up embedding many short texts such as labels
+
+    When multi_process is enabled the instance owns a pool of worker processes,
+    each loading the model once, which is reused across embed_data calls. Call
+    close() or use the instance as a context manager to shut the pool down.
     """
 
-    def __init__(self, modality, multi_process=False, n_processes=1, hosted=False):
+    def __init__(
+        self,
+        modality,
+        multi_process=False,
+        n_processes=1,
+        hosted=False,
+        max_batch=32,
+        max_wait_ms=5.0,
+        modalities=None,
+        pack_text=False,
+    ):
         if not isinstance(modality, str) or modality not in {
             "text",
             "audio",
@@ -66,13 +407,102 @@ class Pegasus:
         self.multi_process = multi_process and n_processes > 1
         self.n_processes = n_processes
         self.hosted = False
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.modalities = modalities
+        self.pack_text = pack_text
+        self._executor = None
+        self._embedding_function = None
+        self._inference_executor = None
+        self._batchers = {}
+
+    def _get_embedding_function(self):
+        """
+        Returns the in-process embedding function, loading the model on first use
+        """
+        if self._embedding_function is None:
+            self._embedding_function = MultiModalEmbeddingFunction(
+                self.modality, modalities=self.modalities, pack_text=self.pack_text
+            )
+        return self._embedding_function
+
+    def _get_executor(self):
+        """
+        Returns the worker pool, starting it on first use
+
+        Returns:
+            a ProcessPoolExecutor whose workers have the model preloaded
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.n_processes,
+                initializer=_init_worker,
+                initargs=(self.modality, self.modalities, self.pack_text),
+            )
+        return self._executor
+
+    def _discard_broken_executor(self, error):
+        """
+        Drops the worker pool if error shows it is broken, e.g. a worker failed
+        to load the model or died, so that the next call starts a fresh pool
+        """
+        if isinstance(error, BrokenProcessPool) and self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _get_batcher(self, modality):
+        """
+        Returns the aembed batcher for a modality, creating it on first use
 
-    def _embed_data(self, data):
+        All batchers share one inference thread and the in-process model
+        """
+        if modality not in self._batchers:
+            if self._inference_executor is None:
+                self._inference_executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="pegasus-inference"
+                )
+            self._batchers[modality] = DynamicBatcher(
+                partial(self._embed_data, modality=modality, return_format="numpy"),
+                executor=self._inference_executor,
+                max_batch=self.max_batch,
+                max_wait_ms=self.max_wait_ms,
+            )
+        return self._batchers[modality]
+
+    def close(self):
+        """
+        Shuts down the worker pool and the aembed inference thread, if started,
+        and releases the in-process model
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+        for batcher in self._batchers.values():
+            batcher.close()
+        self._batchers = {}
+        if self._inference_executor is not None:
+            self._inference_executor.shutdown(wait=True)
+            self._inference_executor = None
+
+        if self._embedding_function is not None:
+            self._embedding_function.close()
+            self._embedding_function = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _embed_data(self, data, modality=None, return_format="list"):
         """
         Embeds the data using MultiModalEmbeddingFunction
 
         Args:
             data: a numpy array representing the data
+            modality: the modality of the data, defaults to the instance's modality
+            return_format: "list", "numpy" or "torch"
 
         Returns:
             The embeddings generated by MultiModalEmbeddingFunction
@@ -80,43 +510,353 @@ class Pegasus:
         """
         if self.modality not in {"text", "audio", "vision", "sensor", "heatmap"}:
             raise ValueError("Invalid modality")
-        return optimized_embedding_function(self.modality, data)
+        try:
+            return self._get_embedding_function()(
+                data, modality=modality, return_format=return_format
+            )
+        except Exception as e:
+            logger.error(f"Failed to generate embeddings: {str(e)}")
+            raise
+
+    def _validate_batching(self, batch_size, max_batch_bytes, return_format):
+        """
+        Validates the batching and output arguments shared by the embed methods
+        """
+        if return_format not in RETURN_FORMATS:
+            logger.error(f"Invalid return_format value: {return_format}")
+            raise ValueError(f"return_format should be one of {RETURN_FORMATS}")
 
-    def embed_data(self, data):
+        if batch_size is not None and (
+            not isinstance(batch_size, int) or batch_size < 1
+        ):
+            logger.error(f"Invalid batch_size value: {batch_size}")
+            raise ValueError("batch_size should be a positive integer")
+
+        if max_batch_bytes is not None and (
+            not isinstance(max_batch_bytes, int) or max_batch_bytes < 1
+        ):
+            logger.error(f"Invalid max_batch_bytes value: {max_batch_bytes}")
+            raise ValueError("max_batch_bytes should be a positive integer")
+
+    def embed_data(
+        self,
+        data,
+        batch_size=None,
+        max_batch_bytes=None,
+        return_format="list",
+        out=None,
+    ):
         """
         Embeds the data using MultiModalEmbeddingFunction
 
-        if multiprocessing is enabled, the data is split and processed in parallel
+        The data is split into micro-batches which are run through the model one
+        at a time, or in parallel if multiprocessing is enabled, and the results
+        are reassembled in input order
 
         Inputs:
             data: a numpy array or a list representing the data
+            batch_size: the maximum number of items per forward pass. Defaults to
+                the whole input, or an even share per worker when multiprocessing
+            max_batch_bytes: optional cap on the estimated size of a batch in bytes
+                (text length, or size of the files the paths point to)
+            return_format: "list" for a list of lists, "numpy" for a single (N, D)
+                float32 ndarray or "torch" for a (N, D) float32 tensor
+            out: optional preallocated (N, D) float32 ndarray, memmap or tensor the
+                embeddings are written into, returned as is. Requires the "numpy"
+                or "torch" return_format
 
         Returns:
-            the embeddings generated by the MultiModalEmbeddingFunction
+            the embedding of each item, in input order
 
         """
+        self._validate_batching(batch_size, max_batch_bytes, return_format)
+
         if not isinstance(data, np.ndarray):
             try:
-                data = np.array(data)
+                data = _as_array(data)
             except Exception as e:
                 logger.error(f"Failed to convert data to numpy array: {str(e)}")
                 raise
 
+        if out is not None and return_format == "list":
+            logger.error("Invalid out buffer for the list return_format")
+            raise ValueError('out requires the "numpy" or "torch" return_format')
+
+        if out is not None and len(out) != len(data):
+            logger.error(
+                f"Invalid out buffer with {len(out)} rows for {len(data)} items"
+            )
+            raise ValueError("out should have one row per item")
+
+        batch_format = "list" if return_format == "list" else "numpy"
+
         if not self.multi_process:
-            return self._embed_data(data)
+            results = (
+                (start, self._embed_data(batch, return_format=batch_format))
+                for start, batch in _iter_batches(
+                    data, self.modality, batch_size, max_batch_bytes
+                )
+            )
+            return _collect_embeddings(results, len(data), return_format, out)
 
-        if self.multi_process:
-            try:
-                with ProcessPoolExecutor(max_workers=self.n_processes) as executor:
-                    future_to_data = {
-                        executor.submit(self._embed_data, d): d for d in data
-                    }
-                    return {
-                        future_to_data[future]: future.result()
-                        for future in as_completed(future_to_data)
-                    }
-            except Exception as e:
-                logger.error(f"Failed to embed data in parallel: {str(e)}")
-                raise
-        else:
-            return self._embed_data(data)
+        if batch_size is None:
+            batch_size = max(math.ceil(len(data) / self.n_processes), 1)
+
+        try:
+            # at most two batches per worker are queued, and each result is
+            # written into the output as it arrives
+            results = _submit_bounded(
+                self._get_executor(),
+                _embed_in_worker,
+                (
+                    (start, (batch, batch_format))
+                    for start, batch in _iter_batches(
+                        data, self.modality, batch_size, max_batch_bytes
+                    )
+                ),
+                2 * self.n_processes,
+            )
+            return _collect_embeddings(results, len(data), return_format, out)
+        except Exception as e:
+            logger.error(f"Failed to embed data in parallel: {str(e)}")
+            self._discard_broken_executor(e)
+            raise
+
+    def embed_multi(
+        self, data, batch_size=None, max_batch_bytes=None, return_format="list"
+    ):
+        """
+        Embeds inputs of several modalities with one shared model
+
+        Each modality is split into micro-batches, and a batch of every modality
+        goes through the same model in a single forward pass, so a mixed
+        workload needs one copy of the weights instead of one per modality
+
+        Inputs:
+            data: a dict mapping each modality, e.g. "text" "vision" "audio", to a
+                numpy array or a list of its data
+            batch_size: the maximum number of items per forward pass of each modality
+            max_batch_bytes: optional cap on the estimated size of a batch in bytes
+            return_format: "list", "numpy" or "torch"
+
+        Returns:
+            a dict mapping each modality to the embeddings of its items, in input order
+        """
+        self._validate_batching(batch_size, max_batch_bytes, return_format)
+
+        if not isinstance(data, dict):
+            logger.error(f"Invalid data for embed_multi: {type(data)}")
+            raise ValueError("data should be a dict mapping modalities to their data")
+
+        arrays = {}
+        for modality, modality_data in data.items():
+            if modality not in {"text", "audio", "vision", "sensor", "heatmap"}:
+                logger.error(f"Invalid modality: {modality}")
+                raise ValueError("Invalid modality")
+            if not isinstance(modality_data, np.ndarray):
+                try:
+                    modality_data = _as_array(modality_data)
+                except Exception as e:
+                    logger.error(f"Failed to convert data to numpy array: {str(e)}")
+                    raise
+            arrays[modality] = modality_data
+
+        if self.multi_process and batch_size is None and arrays:
+            longest = max(len(modality_data) for modality_data in arrays.values())
+            batch_size = max(math.ceil(longest / self.n_processes), 1)
+
+        batch_format = "list" if return_format == "list" else "numpy"
+        rounds = _iter_multi_batches(arrays, batch_size, max_batch_bytes)
+        collectors = {
+            modality: _EmbeddingCollector(len(modality_data), return_format)
+            for modality, modality_data in arrays.items()
+        }
+
+        try:
+            if not self.multi_process:
+                embedding_function = self._get_embedding_function()
+                results = (
+                    (
+                        {m: start for m, (start, _) in round_batches.items()},
+                        embedding_function.embed_multi(
+                            {m: batch for m, (_, batch) in round_batches.items()},
+                            return_format=batch_format,
+                        ),
+                    )
+                    for round_batches in rounds
+                )
+            else:
+                results = _submit_bounded(
+                    self._get_executor(),
+                    _embed_multi_in_worker,
+                    (
+                        (
+                            {m: start for m, (start, _) in round_batches.items()},
+                            (
+                                {m: batch for m, (_, batch) in round_batches.items()},
+                                batch_format,
+                            ),
+                        )
+                        for round_batches in rounds
+                    ),
+                    2 * self.n_processes,
+                )
+            for starts, embeddings in results:
+                for modality, start in starts.items():
+                    collectors[modality].add(start, embeddings[modality])
+        except Exception as e:
+            logger.error(f"Failed to embed multi-modal data: {str(e)}")
+            self._discard_broken_executor(e)
+            raise
+
+        return {
+            modality: collector.result() for modality, collector in collectors.items()
+        }
+
+    async def aembed(self, item, modality=None):
+        """
+        Embeds a single item from asyncio code
+
+        Concurrent calls are batched per modality, up to max_batch items or
+        max_wait_ms, and each batch runs through the in-process model on a
+        dedicated inference thread so the event loop is never blocked
+
+        Inputs:
+            item: a single input item, e.g. a text or a file path
+            modality: the modality of the item, defaults to the instance's modality
+
+        Returns:
+            the embedding of the item as a float32 ndarray
+        """
+        modality = modality or self.modality
+        if modality not in {"text", "audio", "vision", "sensor", "heatmap"}:
+            logger.error(f"Invalid modality: {modality}")
+            raise ValueError("Invalid modality")
+        return await self._get_batcher(modality).submit(item)
+
+    def embed_iter(
+        self,
+        iterable,
+        batch_size=32,
+        prefetch=None,
+        max_batch_bytes=None,
+        return_format="list",
+    ):
+        """
+        Lazily embeds the items of an iterable with bounded memory
+
+        Items are pulled from the iterable only as batches are needed, so it can
+        be a generator over an arbitrarily large corpus, and at most prefetch
+        batches are in flight at any time
+
+        Inputs:
+            iterable: any iterable of input items, e.g. lines of a manifest
+            batch_size: the maximum number of items per forward pass
+            prefetch: the maximum number of batches in flight when multiprocessing,
+                defaults to two per worker. Batches run one at a time otherwise
+            max_batch_bytes: optional cap on the estimated size of a batch in bytes
+            return_format: "list", "numpy" or "torch"
+
+        Returns:
+            a generator of (indices, embeddings) for each batch as soon as it
+            completes, where indices is an int64 ndarray of the positions of the
+            items in the iterable. Batches may complete out of order when
+            multiprocessing
+        """
+        self._validate_batching(batch_size, max_batch_bytes, return_format)
+        if batch_size is None:
+            logger.error("Invalid batch_size value: None")
+            raise ValueError("batch_size should be a positive integer")
+
+        if prefetch is None:
+            prefetch = 2 * self.n_processes
+        if not isinstance(prefetch, int) or prefetch < 1:
+            logger.error(f"Invalid prefetch value: {prefetch}")
+            raise ValueError("prefetch should be a positive integer")
+
+        # validated above rather than in the generator, so that bad arguments
+        # fail at the call instead of on the first next()
+        return self._embed_iter(
+            iterable, batch_size, prefetch, max_batch_bytes, return_format
+        )
+
+    def _embed_iter(
+        self, iterable, batch_size, prefetch, max_batch_bytes, return_format
+    ):
+        """
+        The generator behind embed_iter, with validated arguments
+        """
+        batches = _iter_stream_batches(
+            iterable, self.modality, batch_size, max_batch_bytes
+        )
+
+        if not self.multi_process:
+            for start, batch in batches:
+                yield (
+                    np.arange(start, start + len(batch)),
+                    self._embed_data(batch, return_format=return_format),
+                )
+            return
+
+        batch_format = "list" if return_format == "list" else "numpy"
+        results = _submit_bounded(
+            self._get_executor(),
+            _embed_in_worker,
+            (((start, len(batch)), (batch, batch_format)) for start, batch in batches),
+            prefetch,
+        )
+        try:
+            for (start, size), embeddings in results:
+                if return_format == "torch":
+                    embeddings = torch.from_numpy(embeddings)
+                yield np.arange(start, start + size), embeddings
+        except Exception as e:
+            logger.error(f"Failed to embed data in parallel: {str(e)}")
+            self._discard_broken_executor(e)
+            raise
+        finally:
+            # cancels the batches still in flight when the caller stops early
+            results.close()
+
+    def embed_long_text(
+        self,
+        iterable,
+        window_overlap=16,
+        batch_size=32,
+        pooling="mean",
+        return_format="list",
+    ):
+        """
+        Lazily embeds texts longer than the 77 token context of the text tower
+
+        Each text is split into overlapping token windows, the windows of
+        consecutive texts share forward passes, and the windows of each text are
+        pooled back into one embedding. Runs in this process
+
+        Inputs:
+            iterable: any iterable of texts, e.g. a generator over a corpus
+            window_overlap: the number of tokens shared by consecutive windows
+            batch_size: the number of windows per forward pass
+            pooling: "mean" or "length" to weight windows by their number of tokens
+            return_format: "list", "numpy" or "torch"
+
+        Returns:
+            a generator of (indices, embeddings) for the texts completed by each
+            forward pass, in order, where indices is an int64 ndarray of their
+            positions
+        """
+        self._validate_batching(batch_size, None, return_format)
+        if batch_size is None:
+            logger.error("Invalid batch_size value: None")
+            raise ValueError("batch_size should be a positive integer")
+        if pooling not in POOLINGS:
+            logger.error(f"Invalid pooling value: {pooling}")
+            raise ValueError(f"pooling should be one of {POOLINGS}")
+
+        return self._get_embedding_function().embed_long_text(
+            iterable,
+            window_overlap=window_overlap,
+            batch_size=batch_size,
+            pooling=pooling,
+            return_format=return_format,
+        )
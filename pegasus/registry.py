@@ -0,0 +1,205 @@
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+import torch
+
+from pegasus.ImageBind.models import imagebind_model
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+ModelKey = namedtuple(
+    "ModelKey",
+    ["checkpoint", "precision", "adapter", "device", "modalities", "pack_text"],
+    defaults=(False,),
+)
+
+
+def model_nbytes(model):
+    """Return the memory held by the parameters and buffers of a model in bytes"""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def load_model(key):
+    """
+    Builds an imagebind_huge model for a registry key
+
+    Args:
+        key (ModelKey): The checkpoint, precision, adapter, device and modalities
+            to load. The adapter, if any, is a path to a state dict whose weights
+            are loaded over the base checkpoint, e.g. fine-tuned heads. Only the
+            towers of the given modalities are built, None for all of them.
+            pack_text packs several short texts per text trunk row.
+    Returns:
+        The model in eval mode, on the key's device and dtype.
+    """
+    model = imagebind_model.imagebind_huge(
+        pretrained=True,
+        checkpoint_path=key.checkpoint,
+        modalities=key.modalities,
+        fast_load=True,
+        pack_text=key.pack_text,
+    )
+    if key.adapter is not None:
+        model.load_state_dict(torch.load(key.adapter, map_location="cpu"), strict=False)
+    model.eval()
+    model.to(device=key.device, dtype=PRECISIONS[key.precision])
+    return model
+
+
+class _Entry(object):
+    def __init__(self, model, nbytes):
+        self.model = model
+        self.nbytes = nbytes
+        self.refcount = 0
+
+
+class ModelRegistry(object):
+    """
+    Process-wide registry of loaded models
+
+    Models are keyed by checkpoint, precision, adapter and device, so every
+    embedding function asking for the same weights shares one copy whatever its
+    modality. A request for some modality towers is served by any resident
+    model that has them all. Users are refcounted, and models nobody holds stay resident until
+    the memory budget is exceeded, at which point they are evicted least
+    recently used first.
+
+    Args:
+        memory_budget (int): The maximum number of bytes of resident weights,
+            None for no limit. Models in use are never evicted, so the budget
+            can be exceeded while they are all held.
+        loader (Callable): Builds a model from a ModelKey.
+    """
+
+    def __init__(self, memory_budget=None, loader=load_model):
+        self.memory_budget = memory_budget
+        self.loader = loader
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def acquire(
+        self,
+        checkpoint_path=imagebind_model.DEFAULT_CHECKPOINT_PATH,
+        precision="fp32",
+        adapter=None,
+        device="cpu",
+        modalities=None,
+        pack_text=False,
+    ):
+        """
+        Returns the model for the given weights, loading it if it is not resident.
+        modalities lists the towers the caller needs, None for all of them.
+        Models that pack texts are separate from those that do not.
+        Every call must be paired with a call to release.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"Invalid precision: {precision}, expected one of {tuple(PRECISIONS)}"
+            )
+        if modalities is not None:
+            modalities = tuple(sorted(set(modalities)))
+        key = ModelKey(
+            checkpoint_path, precision, adapter, str(device), modalities, pack_text
+        )
+
+        with self._lock:
+            key = self._find(key)
+            entry = self._entries.get(key)
+            if entry is None:
+                logger.info(f"Loading model {key}")
+                model = self.loader(key)
+                entry = _Entry(model, model_nbytes(model))
+                self._entries[key] = entry
+            entry.refcount += 1
+            self._entries.move_to_end(key)
+            self._evict()
+            return entry.model
+
+    def _find(self, key):
+        """
+        Returns the key of a resident model that can serve the request, or the
+        requested key itself if there is none
+        """
+        if key in self._entries:
+            return key
+        for resident in reversed(self._entries):
+            if resident[:4] != key[:4] or resident.pack_text != key.pack_text:
+                continue
+            if resident.modalities is None or (
+                key.modalities is not None
+                and set(key.modalities) <= set(resident.modalities)
+            ):
+                return resident
+        return key
+
+    def release(self, model):
+        """
+        Drops one reference to a model returned by acquire
+        """
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.model is model:
+                    if entry.refcount > 0:
+                        entry.refcount -= 1
+                    break
+            self._evict()
+
+    def set_memory_budget(self, memory_budget):
+        """
+        Changes the memory budget and evicts idle models to fit in it
+        """
+        with self._lock:
+            self.memory_budget = memory_budget
+            self._evict()
+
+    def _evict(self):
+        if self.memory_budget is None:
+            return
+        total = sum(entry.nbytes for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.memory_budget:
+                break
+            entry = self._entries[key]
+            if entry.refcount == 0:
+                logger.info(f"Evicting model {key}")
+                del self._entries[key]
+                total -= entry.nbytes
+        if total > self.memory_budget:
+            logger.warning(
+                f"Resident models use {total} bytes, over the budget of "
+                f"{self.memory_budget} bytes, but all of them are in use"
+            )
+
+    def resident(self):
+        """
+        Reports the resident models, least recently used first
+
+        Returns:
+            A list of dicts with the checkpoint, precision, adapter, device,
+            modalities, pack_text, size in bytes and number of users of each model.
+        """
+        with self._lock:
+            return [
+                dict(key._asdict(), nbytes=entry.nbytes, refcount=entry.refcount)
+                for key, entry in self._entries.items()
+            ]
+
+    def clear(self):
+        """
+        Evicts every idle model
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if self._entries[key].refcount == 0:
+                    del self._entries[key]
+
+
+model_registry = ModelRegistry()
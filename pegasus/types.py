@@ -2,12 +2,19 @@ from abc import ABC, abstractmethod
 from typing import Dict, List, Optional, Sequence, TypeVar, Union
 
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 from typing_extensions import Literal, Protocol, TypedDict
 
 import pegasus.errors as errors
 from pegasus.ImageBind.models.imagebind_model import ModalityType
 
+
+def cosine_similarity(X, Y):
+    # sklearn is only needed by the search functions, so it is imported on use
+    from sklearn.metrics import pairwise
+
+    return pairwise.cosine_similarity(X, Y)
+
+
 ID = str
 IDs = List[ID]
 
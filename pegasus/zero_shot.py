@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+from functools import partial
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATES = ("a photo of a {}.",)
+
+# the model_id of prototypes built by the default text embedding function
+DEFAULT_MODEL_ID = "imagebind_huge/fp32"
+
+
+def _normalize(x):
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+class ZeroShotClassifier:
+    """
+    Classifies embeddings of any modality against a fixed set of labels
+
+    Each label is embedded once per prompt template, and the normalized mean
+    over templates becomes its prototype. Queries are scored against the
+    (C, D) prototype matrix by cosine similarity, one chunk of classes at a
+    time, keeping a running top-k, so large label sets never need a full
+    (N, C) score matrix.
+
+    Args:
+        labels (List[str]): The class names, in the order of the prototypes
+        prototypes (np.ndarray): The (C, D) unit-norm prototypes
+        templates (List[str]): The templates the prototypes were built from
+        model_id (str): Identifies the model the prototypes were embedded
+            with, None if unknown
+    """
+
+    def __init__(self, labels, prototypes, templates=DEFAULT_TEMPLATES, model_id=None):
+        if len(labels) != len(prototypes):
+            raise ValueError(
+                f"Got {len(labels)} labels for {len(prototypes)} prototypes"
+            )
+        self.labels = list(labels)
+        self.prototypes = prototypes
+        self.templates = list(templates)
+        self.model_id = model_id
+
+    @classmethod
+    def from_labels(
+        cls,
+        labels,
+        embed_fn=None,
+        templates=DEFAULT_TEMPLATES,
+        batch_size=256,
+        path=None,
+        model_id=None,
+    ):
+        """
+        Builds the prototypes of a label set, or loads them from path if they
+        were saved there for the same labels, templates and model
+
+        Args:
+            labels (List[str]): The class names
+            embed_fn (Callable): Maps a list of texts to their (N, D) embeddings,
+                e.g. Pegasus("text").embed_data. Defaults to a text-only
+                MultiModalEmbeddingFunction
+            templates (List[str]): Prompt templates with a {} for the label
+            batch_size (int): The number of prompts per call to embed_fn
+            path (str): Optional directory the prototypes are saved to and
+                loaded from
+            model_id (str): Identifies the model behind embed_fn, e.g. its
+                checkpoint, precision and adapter. Saved prototypes are only
+                reused for the same model_id, so with a custom embed_fn and no
+                model_id they are always rebuilt
+        """
+        if model_id is None and embed_fn is None:
+            model_id = DEFAULT_MODEL_ID
+        if path is not None and os.path.exists(os.path.join(path, "labels.json")):
+            classifier = cls.load(path)
+            if (
+                model_id is not None
+                and classifier.model_id == model_id
+                and classifier.labels == list(labels)
+                and classifier.templates == list(templates)
+            ):
+                return classifier
+            logger.info(f"Labels, templates or model changed, rebuilding {path}")
+
+        function = None
+        if embed_fn is None:
+            from pegasus.embedding_functions import MultiModalEmbeddingFunction
+
+            function = MultiModalEmbeddingFunction("text", modalities=["text"])
+            embed_fn = partial(function, return_format="numpy")
+
+        prototypes = None
+        try:
+            for template in templates:
+                prompts = [template.format(label) for label in labels]
+                embeddings = np.concatenate(
+                    [
+                        _normalize(np.asarray(embed_fn(prompts[i : i + batch_size])))
+                        for i in range(0, len(prompts), batch_size)
+                    ]
+                )
+                prototypes = (
+                    embeddings if prototypes is None else prototypes + embeddings
+                )
+        finally:
+            if function is not None:
+                function.close()
+        classifier = cls(
+            labels, _normalize(prototypes).astype(np.float32), templates, model_id
+        )
+
+        if path is not None:
+            classifier.save(path)
+        return classifier
+
+    def save(self, path):
+        """
+        Saves the prototypes to path/prototypes.npy and the labels, templates
+        and model_id to path/labels.json
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "prototypes.npy"), self.prototypes)
+        with open(os.path.join(path, "labels.json"), "w") as f:
+            json.dump(
+                {
+                    "labels": self.labels,
+                    "templates": self.templates,
+                    "model_id": self.model_id,
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads a classifier saved with save, memory-mapping the prototypes
+        unless mmap is False
+        """
+        with open(os.path.join(path, "labels.json")) as f:
+            metadata = json.load(f)
+        prototypes = np.load(
+            os.path.join(path, "prototypes.npy"), mmap_mode="r" if mmap else None
+        )
+        return cls(
+            metadata["labels"],
+            prototypes,
+            metadata["templates"],
+            metadata.get("model_id"),
+        )
+
+    def predict(self, queries, k=5, chunk_size=16384):
+        """
+        Returns the k most similar labels of each query
+
+        Args:
+            queries: The (N, D) embeddings to classify, as an array, a tensor
+                or a list of lists
+            k (int): The number of labels per query
+            chunk_size (int): The number of classes scored per matmul
+
+        Returns:
+            the (N, k) indices of the labels, best first, and their cosine
+            similarities
+        """
+        if hasattr(queries, "detach"):
+            queries = queries.detach().float().cpu().numpy()
+        queries = _normalize(np.asarray(queries, dtype=np.float32))
+        k = min(k, len(self.labels))
+
+        top_scores = np.empty((len(queries), 0), dtype=np.float32)
+        top_indices = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.labels), chunk_size):
+            chunk = np.asarray(self.prototypes[start : start + chunk_size])
+            scores = np.concatenate([top_scores, queries @ chunk.T], axis=1)
+            chunk_indices = np.broadcast_to(
+                np.arange(start, start + len(chunk)), (len(queries), len(chunk))
+            )
+            indices = np.concatenate([top_indices, chunk_indices], axis=1)
+            if scores.shape[1] > k:
+                keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, keep, axis=1)
+                indices = np.take_along_axis(indices, keep, axis=1)
+            top_scores, top_indices = scores, indices
+
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return (
+            np.take_along_axis(top_indices, order, axis=1),
+            np.take_along_axis(top_scores, order, axis=1),
+        )
+
+    def classify(self, queries, k=1, chunk_size=16384):
+        """
+        Returns the k best (label, score) pairs of each query
+        """
+        indices, scores = self.predict(queries, k, chunk_size)
+        return [
+            [(self.labels[i], float(s)) for i, s in zip(row_indices, row_scores)]
+            for row_indices, row_scores in zip(indices, scores)
+        ]
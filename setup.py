@@ -34,6 +34,7 @@ setup(
         "fvcore",
         "decord==0.6.0",
         "numba",
+        "safetensors",
         "joblib",
     ],
     classifiers=[
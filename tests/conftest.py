@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+from pegasus.ImageBind.models.imagebind_model import ImageBindModel
+
+# A few blocks of small width keep every modality quick to build and run on CPU
+SMALL_CONFIG = dict(
+    vision_embed_dim=64,
+    vision_num_blocks=2,
+    vision_num_heads=4,
+    text_embed_dim=64,
+    text_num_blocks=2,
+    text_num_heads=4,
+    out_embed_dim=32,
+    audio_embed_dim=64,
+    audio_num_blocks=2,
+    audio_num_heads=4,
+    depth_embed_dim=64,
+    depth_num_blocks=2,
+    depth_num_heads=4,
+    thermal_embed_dim=64,
+    thermal_num_blocks=2,
+    thermal_num_heads=4,
+    imu_embed_dim=64,
+    imu_num_blocks=2,
+    imu_num_heads=4,
+)
+
+
+@pytest.fixture
+def small_model():
+    def make(**kwargs):
+        torch.manual_seed(0)
+        return ImageBindModel(**{**SMALL_CONFIG, **kwargs}).eval()
+
+    return make
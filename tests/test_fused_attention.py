@@ -0,0 +1,39 @@
+import pytest
+import torch
+
+from pegasus.ImageBind.data import load_and_transform_text
+
+TEXTS = ["a dog", "a photo of a very large cat sitting on a mat", "x", "hello world"]
+
+
+def make_inputs():
+    torch.manual_seed(1)
+    return {
+        "vision": torch.randn(3, 3, 224, 224),
+        "text": load_and_transform_text(TEXTS, "cpu"),
+        "audio": torch.randn(2, 3, 1, 128, 204),
+        "depth": torch.randn(2, 1, 224, 224),
+        "thermal": torch.randn(2, 1, 224, 224),
+        "imu": torch.randn(2, 6, 2000),
+    }
+
+
+@pytest.mark.parametrize("pool_final_block", [True, False])
+def test_fused_attention_matches_multihead_attention(small_model, pool_final_block):
+    reference = small_model(fused_attention=False, pool_final_block=False)
+    fused = small_model(fused_attention=True, pool_final_block=pool_final_block)
+    # the zero initialised attention biases would hide a misplaced bias
+    with torch.no_grad():
+        for param in reference.parameters():
+            param.add_(0.02 * torch.randn_like(param))
+    # both attention layouts share the MultiheadAttention parameter names
+    fused.load_state_dict(reference.state_dict(), strict=True)
+    inputs = make_inputs()
+    with torch.no_grad():
+        expected = reference(inputs)
+        actual = fused(inputs)
+    assert actual.keys() == expected.keys() == inputs.keys()
+    for modality in inputs:
+        torch.testing.assert_close(
+            actual[modality], expected[modality], rtol=0, atol=1e-5, msg=modality
+        )
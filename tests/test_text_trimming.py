@@ -0,0 +1,29 @@
+import torch
+
+from pegasus.ImageBind.data import load_and_transform_text
+
+TEXTS = ["a dog", "a photo of a very large cat sitting on a mat", "x", "hello world"]
+
+
+def embed_text(model, text, trim_padding):
+    model.modality_preprocessors["text"].trim_padding = trim_padding
+    with torch.no_grad():
+        return model({"text": text})["text"]
+
+
+def test_trimmed_text_matches_untrimmed(small_model):
+    model = small_model()
+    text = load_and_transform_text(TEXTS, "cpu")
+    trimmed = embed_text(model, text, True)
+    untrimmed = embed_text(model, text, False)
+    assert trimmed.shape == (len(TEXTS), 32)
+    torch.testing.assert_close(trimmed, untrimmed, rtol=0, atol=1e-5)
+
+
+def test_trimmed_text_matches_untrimmed_per_text(small_model):
+    # a batch is cut to its own longest text, so each text alone is cut further
+    model = small_model()
+    text = load_and_transform_text(TEXTS, "cpu")
+    untrimmed = embed_text(model, text, False)
+    single = torch.cat([embed_text(model, t[None], True) for t in text])
+    torch.testing.assert_close(single, untrimmed, rtol=0, atol=1e-5)
@@ -0,0 +1,67 @@
+import pytest
+import torch
+from torch import nn
+
+from pegasus.ImageBind.models.multimodal_preprocessors import (
+    PadIm2Video,
+    PatchEmbedGeneric,
+)
+
+
+def padded_stem(pad_type, bias):
+    torch.manual_seed(0)
+    return PatchEmbedGeneric(
+        proj_stem=[
+            PadIm2Video(pad_type=pad_type, ntimes=2),
+            nn.Conv3d(
+                in_channels=3,
+                out_channels=16,
+                kernel_size=(2, 14, 14),
+                stride=(2, 14, 14),
+                bias=bias,
+            ),
+        ]
+    )
+
+
+@pytest.mark.parametrize("pad_type", ["repeat", "zero"])
+@pytest.mark.parametrize("bias", [False, True])
+def test_folded_stem_matches_padded_conv3d(pad_type, bias):
+    stem = padded_stem(pad_type, bias)
+    assert stem.image_fold == pad_type
+    x = torch.randn(2, 3, 56, 42)
+    with torch.no_grad():
+        folded = stem(x)
+        padded = stem.proj(x).flatten(2).transpose(1, 2)
+    assert folded.shape == padded.shape == (2, 12, 16)
+    torch.testing.assert_close(folded, padded, rtol=0, atol=1e-5)
+
+
+def test_video_stem_is_not_folded():
+    stem = padded_stem("repeat", False)
+    video = torch.randn(2, 3, 4, 28, 28)
+    with torch.no_grad():
+        out = stem(video)
+    assert out.shape == (2, 8, 16)
+
+
+def test_stem_with_other_kernel_is_not_folded():
+    stem = PatchEmbedGeneric(
+        proj_stem=[
+            PadIm2Video(pad_type="repeat", ntimes=2),
+            nn.Conv3d(3, 16, kernel_size=(1, 14, 14), stride=(1, 14, 14)),
+        ]
+    )
+    assert stem.image_fold is None
+
+
+def test_folded_vision_model_matches_padded(small_model):
+    model = small_model()
+    stem = model.modality_preprocessors["vision"].rgbt_stem
+    assert stem.image_fold == "repeat"
+    vision = torch.randn(3, 3, 224, 224)
+    with torch.no_grad():
+        folded = model({"vision": vision})["vision"]
+        stem.image_fold = None
+        padded = model({"vision": vision})["vision"]
+    torch.testing.assert_close(folded, padded, rtol=0, atol=1e-5)